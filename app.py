@@ -1,8 +1,7 @@
 import streamlit as st
 from datetime import datetime, timedelta, timezone
-from split_module import job_split
-from rewrite_with_detail import job_rewrite
-from rewrite_with_pr import rewrite_pr
+from response_cache import render_cache_stats
+from job_runner import render_job_list
 
 st.set_page_config(
     page_title="求人支援AIツール",
@@ -26,9 +25,19 @@ except Exception:
     st.sidebar.markdown("---")
     st.sidebar.caption("🕒 最終更新: 情報なし")
 
+# --- キャッシュ統計（処理後の値を表示するため枠だけ先に確保） ---
+cache_stats_area = st.sidebar.empty()
+render_job_list(st.sidebar)
+
+# 各モードのモジュールは選ばれたときに初めて読み込む（起動時間を短くするため）
 if menu == "業務分割":
+    from split_module import job_split
     job_split()
 elif menu == "言い換え複製(職種と仕事内容)":
+    from rewrite_with_detail import job_rewrite
     job_rewrite()
 elif menu == "言い換え複製(職種とキャッチ)":
-    rewrite_pr()
\ No newline at end of file
+    from rewrite_with_pr import rewrite_pr
+    rewrite_pr()
+
+render_cache_stats(cache_stats_area)
@@ -0,0 +1,180 @@
+import json
+import time
+from llm_engine import MODEL
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+DEFAULT_POLL_INTERVAL = 30
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# 再開時にこの状態のバッチは結果を使えないため、送り直す
+UNUSABLE_STATUSES = ("failed", "expired", "cancelling", "cancelled")
+# 1つのバッチに入れられるリクエスト数と入力ファイルの大きさの上限（超えた分は別のバッチに分ける）
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+
+# --- OpenAI Batch API（夜間の一括処理向け） ---
+def build_batch_line(custom_id, prompt, temperature, model=MODEL):
+    return (json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature
+        }
+    }, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def build_batch_files(requests, model=MODEL):
+    # requests: (custom_id, prompt, temperature) のリスト。
+    # 上限に収まるように分けた (custom_id のリスト, 入力ファイル) を1つずつ返す（全体を一度にメモリに載せない）
+    custom_ids = []
+    lines = []
+    size = 0
+    for custom_id, prompt, temperature in requests:
+        line = build_batch_line(custom_id, prompt, temperature, model)
+        if lines and (len(lines) >= MAX_BATCH_REQUESTS or size + len(line) > MAX_BATCH_FILE_BYTES):
+            yield custom_ids, b"".join(lines)
+            custom_ids, lines, size = [], [], 0
+        custom_ids.append(custom_id)
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield custom_ids, b"".join(lines)
+
+
+def submit_batch(client, batch_file, metadata=None):
+    uploaded = client.files.create(file=("batch_input.jsonl", batch_file), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=uploaded.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=COMPLETION_WINDOW,
+        metadata=metadata
+    )
+    return batch.id
+
+
+def cancel_batches(client, batch_ids):
+    for batch_id in batch_ids:
+        try:
+            client.batches.cancel(batch_id)
+        except Exception:
+            # 直前に終了したなどで取り消せなくても、残りのバッチの取り消しは続ける
+            pass
+
+
+def is_reusable(client, batch_id):
+    try:
+        return client.batches.retrieve(batch_id).status not in UNUSABLE_STATUSES
+    except Exception:
+        # 削除済み・別アカウントなどで参照できないバッチは送り直す
+        return False
+
+
+def wait_for_batches(client, batch_ids, poll_interval=DEFAULT_POLL_INTERVAL, on_poll=None):
+    # on_poll(完了件数, 全件数) が例外を出したら（ジョブのキャンセルなど）、実行中のバッチを取り消してから送出する。
+    # 取り消さないと、OpenAI側では処理が続いて料金もかかる
+    batches = {}
+    while True:
+        for batch_id in batch_ids:
+            if batch_id not in batches or batches[batch_id].status not in TERMINAL_STATUSES:
+                batches[batch_id] = client.batches.retrieve(batch_id)
+        running = [batch_id for batch_id, batch in batches.items() if batch.status not in TERMINAL_STATUSES]
+        try:
+            if on_poll is not None:
+                counts = [batch.request_counts for batch in batches.values() if batch.request_counts is not None]
+                on_poll(sum(c.completed for c in counts), sum(c.total for c in counts))
+            if not running:
+                return [batches[batch_id] for batch_id in batch_ids]
+            time.sleep(poll_interval)
+        except BaseException:
+            cancel_batches(client, running)
+            raise
+
+
+def parse_batch_output(text):
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        custom_id = item.get("custom_id")
+        response = item.get("response") or {}
+        body = response.get("body") or {}
+        if item.get("error"):
+            results[custom_id] = f"[ERROR] {item['error'].get('message', item['error'])}"
+        elif response.get("status_code") != 200:
+            message = (body.get("error") or {}).get("message", f"status {response.get('status_code')}")
+            results[custom_id] = f"[ERROR] {message}"
+        else:
+            results[custom_id] = body["choices"][0]["message"]["content"]
+    return results
+
+
+def fetch_batch_results(client, batch):
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            results.update(parse_batch_output(client.files.content(file_id).text))
+    return results
+
+
+def run_batch(client, requests, model=MODEL, poll_interval=DEFAULT_POLL_INTERVAL, on_poll=None, metadata=None,
+              journal=None, job_id=None):
+    # 上限を超える量は複数のバッチに分けて送り、結果は custom_id で1つにまとめる。
+    # journal を渡すと送信したバッチIDを記録し、再開時は使える状態のバッチを待ち直す（送り直さない）
+    if not requests:
+        return {}
+    stage = (metadata or {}).get("stage", "batch")
+    saved = journal.load_batches(job_id) if journal is not None else {}
+    parts = []
+    for part, (custom_ids, batch_file) in enumerate(build_batch_files(requests, model)):
+        key = f"{stage}-{part}"
+        batch_id = saved.get(key)
+        if batch_id is None or not is_reusable(client, batch_id):
+            batch_id = submit_batch(client, batch_file, dict(metadata or {}, part=str(part)))
+            if journal is not None:
+                journal.record_batch(job_id, key, batch_id)
+        parts.append((custom_ids, batch_id))
+
+    batches = wait_for_batches(client, [batch_id for _, batch_id in parts], poll_interval, on_poll)
+    results = {}
+    for (custom_ids, batch_id), batch in zip(parts, batches):
+        results.update(fetch_batch_results(client, batch))
+        # 失敗・期限切れなどで結果が返らなかったリクエストはエラー扱いにする
+        for custom_id in custom_ids:
+            results.setdefault(custom_id, f"[ERROR] batch {batch_id} {batch.status}")
+    return results
+
+
+def run_variation_batches(client, titles, details, num_variations, build_prompt_title, build_prompt_detail,
+                          parse_variations, model=MODEL, poll_interval=DEFAULT_POLL_INTERVAL, on_poll=None,
+                          journal=None, job_id=None):
+    # ステップ2はステップ1のバリエーションに依存するため、2段のバッチを順に実行する
+    title_requests = [
+        (f"title-{i}", build_prompt_title(title, num_variations), 0.7) for i, title in enumerate(titles)
+    ]
+    title_results = run_batch(client, title_requests, model, poll_interval, on_poll, {"stage": "title"}, journal, job_id)
+
+    row_variations = []
+    for i in range(len(titles)):
+        content = title_results[f"title-{i}"]
+        if content.startswith("[ERROR]"):
+            variations = [content for _ in range(num_variations)]
+        else:
+            variations = parse_variations(content)
+        row_variations.append(variations[:num_variations])
+
+    # 職種名の生成に失敗した複製は、案内文も同じエラーにする（エラーの文面では依頼しない）
+    detail_requests = []
+    for i, variations in enumerate(row_variations):
+        for j, var_title in enumerate(variations):
+            if not var_title.startswith("[ERROR]"):
+                detail_requests.append((f"detail-{i}-{j}", build_prompt_detail(var_title, details[i]), 0.7))
+    detail_results = run_batch(client, detail_requests, model, poll_interval, on_poll, {"stage": "detail"}, journal, job_id)
+
+    return [
+        [(var_title, detail_results.get(f"detail-{i}-{j}", var_title).strip()) for j, var_title in enumerate(variations)]
+        for i, variations in enumerate(row_variations)
+    ]
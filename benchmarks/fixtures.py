@@ -0,0 +1,59 @@
+import argparse
+import os
+import random
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+STANDARD_SIZES = [100, 10000, 100000]
+
+PLACES = ["工場での", "倉庫での", "物流センターでの", "店舗での", "オフィスでの", "病院での", ""]
+ROLES = ["製造スタッフ", "検査スタッフ", "ホールスタッフ", "軽作業スタッフ", "事務サポート", "清掃スタッフ", "機械オペレーター"]
+PERKS = ["日払いOK", "即日勤務", "未経験歓迎", "大手企業", "特典付き", "週3日から", ""]
+DUTIES = ["部品の組立", "完成品の検査", "商品のピッキング", "段ボールの梱包", "データ入力", "接客と配膳", "フロアの清掃", "機械の操作"]
+
+
+# --- 合成データ（実際のシートと同じく職種名・仕事内容の重複を含む） ---
+def make_rows(rows, unique_ratio=0.3, seed=0):
+    rng = random.Random(seed)
+    unique = max(1, int(rows * unique_ratio))
+    pool = []
+    for _ in range(unique):
+        perk = rng.choice(PERKS)
+        title = f"{rng.choice(PLACES)}{rng.choice(ROLES)}" + (f" {perk}" if perk else "")
+        duties = "、".join(rng.sample(DUTIES, rng.randint(1, 3)))
+        detail = f"{duties}をお任せします。{rng.choice(['丁寧に教えます。', '残業少なめです。', '服装自由です。'])}"
+        pool.append((title, detail))
+    return [rng.choice(pool) for _ in range(rows)]
+
+
+def write_fixture(path, rows, unique_ratio=0.3, seed=0):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(["職種名", "仕事内容"])
+    for row in make_rows(rows, unique_ratio, seed):
+        sheet.append(list(row))
+    workbook.save(path)
+    return path
+
+
+def fixture_path(rows, unique_ratio=0.3, seed=0):
+    # 一度作ったファイルは使い回す（10万行の生成には数秒かかる）
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    path = os.path.join(FIXTURE_DIR, f"jobs_{rows}_u{int(unique_ratio * 100)}_s{seed}.xlsx")
+    if not os.path.exists(path):
+        write_fixture(path, rows, unique_ratio, seed)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用のExcelファイルを生成します")
+    parser.add_argument("--rows", type=int, nargs="*", default=STANDARD_SIZES)
+    parser.add_argument("--unique-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for rows in args.rows:
+        print(fixture_path(rows, args.unique_ratio, args.seed))
+
+
+if __name__ == "__main__":
+    main()
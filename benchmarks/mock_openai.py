@@ -0,0 +1,243 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Chat Completions API のローカル代替（料金をかけずにスループットを測るため） ---
+# 応答内容はプロンプトのハッシュから決まるので、同じ入力には常に同じ出力を返す
+
+TASK_WORDS = ["部品の組立", "製品の検査", "梱包作業", "ピッキング", "機械操作", "清掃", "データ入力", "電話対応", "品出し", "接客"]
+STREAM_PIECE_CHARS = 4
+TITLE_WORDS = ["スタッフ", "作業員", "担当者", "オペレーター", "アシスタント", "サポート", "リーダー候補", "係"]
+
+
+def _seed(prompt):
+    return int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12], 16)
+
+
+def _bullets(rng, words, count):
+    return "\n".join(f"- {rng.choice(words)}{i + 1}" for i in range(count))
+
+
+def canned_response(prompt, json_mode=False):
+    rng = random.Random(_seed(prompt))
+    if json_mode and "求人ID" in prompt:
+        # 複数行をまとめた作業分割: {"1": [...], "2": [...]}
+        ids = re.findall(r"\[求人ID: (\d+)\]", prompt)
+        return json.dumps({i: [f"{rng.choice(TASK_WORDS)}{n + 1}" for n in range(rng.randint(2, 4))] for i in ids},
+                          ensure_ascii=False)
+    if json_mode:
+        # 複数バリエーションの一括生成: {"items": [...]}
+        match = re.search(r"作成する個数: (\d+)個", prompt)
+        count = int(match.group(1)) if match else 3
+        return json.dumps({"items": [f"案内文{i + 1}:{rng.randrange(10 ** 6)}" for i in range(count)]}, ensure_ascii=False)
+    if "既出の案" in prompt:
+        # 似すぎた複製の作り直し（キャッチコピーまたは職種名を1つだけ返す）
+        if "キャッチコピー:" in prompt:
+            return f"生成文{rng.randrange(10 ** 6)}。"
+        return f"{rng.choice(TITLE_WORDS)}{rng.randrange(1000)}"
+    if "箇条書き" in prompt:
+        match = re.search(r"作成する個数: (\d+)個", prompt)
+        if match:
+            # 職種名のバリエーション
+            return _bullets(rng, TITLE_WORDS, int(match.group(1)))
+        # 作業分割
+        return _bullets(rng, TASK_WORDS, rng.randint(2, 4))
+    return f"生成文{rng.randrange(10 ** 6)}。" * rng.randint(1, 3)
+
+
+class MockSettings:
+    def __init__(self, latency_median=0.2, latency_sigma=0.5, error_rate=0.0, retry_after_ms=200, seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.retry_after_ms = retry_after_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        # 遅延は対数正規分布（sigma=0 なら一定）、429 は error_rate の確率で返す
+        with self.lock:
+            latency = self.latency_median * math.exp(self.rng.gauss(0, self.latency_sigma)) if self.latency_sigma else self.latency_median
+            fail = self.rng.random() < self.error_rate
+        return latency, fail
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def reset(self):
+        with self.lock:
+            self.requests = self.rate_limited = self.prompt_tokens = self.completion_tokens = 0
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens
+            }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # 取り消された呼び出し（ヘッジで使われなかった方など）は、応答を書く前に接続が切れている
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, request, content, usage, latency):
+        # SSE で少しずつ返す（最初の断片までに遅延の3割、残りを断片ごとに分けて待つ）
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [content[i:i + STREAM_PIECE_CHARS] for i in range(0, len(content), STREAM_PIECE_CHARS)] or [""]
+        base = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": request.get("model", "mock")}
+        events = [dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}]) for piece in pieces]
+        events.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            events.append(dict(base, choices=[], usage=usage))
+        time.sleep(latency * 0.3)
+        for event in events:
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            time.sleep(latency * 0.7 / len(events))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"unsupported path: {self.path}"}})
+            return
+
+        settings = self.server.settings
+        stats = self.server.stats
+        latency, fail = settings.draw()
+        streaming = bool(request.get("stream"))
+        if not streaming or fail:
+            time.sleep(latency)
+        with stats.lock:
+            stats.requests += 1
+            if fail:
+                stats.rate_limited += 1
+        if fail:
+            self._send(429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                       {"retry-after-ms": str(settings.retry_after_ms)})
+            return
+
+        prompt = "".join(m.get("content") or "" for m in request.get("messages", []))
+        json_mode = (request.get("response_format") or {}).get("type") == "json_object"
+        content = canned_response(prompt, json_mode)
+        prompt_tokens = len(prompt)
+        completion_tokens = len(content)
+        with stats.lock:
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        if streaming:
+            self._send_stream(request, content, usage, latency)
+            return
+        self._send(200, {
+            "id": f"chatcmpl-mock{stats.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage
+        }, {
+            "x-ratelimit-limit-requests": "1000000",
+            "x-ratelimit-remaining-requests": "999999",
+            "x-ratelimit-reset-requests": "1ms",
+            "x-ratelimit-limit-tokens": "1000000000",
+            "x-ratelimit-remaining-tokens": "999999999",
+            "x-ratelimit-reset-tokens": "1ms"
+        })
+
+
+class MockOpenAIServer:
+    def __init__(self, host="127.0.0.1", port=0, **settings):
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.settings = MockSettings(**settings)
+        self._server.stats = MockStats()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def stats(self):
+        return self._server.stats
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat Completions API のローカル代替サーバー")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-median", type=float, default=0.2)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = MockOpenAIServer(port=args.port, latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                              error_rate=args.error_rate, seed=args.seed)
+    print(f"OPENAI_BASE_URL={server.base_url}")
+    try:
+        server.start()._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import fixture_path
+from mock_openai import MockOpenAIServer
+
+MODES = ["split", "rewrite", "rewrite_pr", "combined"]
+
+
+# --- 子プロセス側: 1つのパイプラインを Streamlit の画面なしで実行する ---
+def run_child(mode, path, options):
+    sys.path.insert(0, ROOT)
+    from metrics import Metrics
+    from pipelines import MODES, run_pipeline
+    metrics = Metrics()
+    flags = {"packed": options["packed"], "multi": options["multi"]}
+    with open(path, "rb") as f:
+        result = run_pipeline(mode, f, options["variations"], options["concurrency"], metrics=metrics,
+                              **{name: value for name, value in flags.items() if name in MODES[mode][3]})
+    metrics.finish()
+    snapshot = metrics.snapshot()
+    print(json.dumps({
+        "elapsed_s": snapshot["elapsed_s"],
+        "rows": snapshot["counters"].get("rows", 0),
+        "output_rows": result.row_count,
+        "error_rows": result.error_count,
+        "counters": snapshot["counters"],
+        "stage_p99_s": {stage: values["p99_s"] for stage, values in snapshot["stages"].items() if stage.startswith("llm:")},
+        # Linux では KB 単位
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }))
+
+
+# --- 親プロセス側: モックサーバーを立て、モード×行数ごとに子プロセスで計測する ---
+def prepare_workdir(server, options):
+    # キャッシュ・ジャーナルが前回の結果を使わないよう、実行ごとに空の作業ディレクトリを用意する
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(
+            "[openai]\n"
+            'api_key = "sk-benchmark"\n'
+            f'base_url = "{server.base_url}"\n'
+            f"requests_per_minute = {options['rpm']}\n"
+            f"tokens_per_minute = {options['tpm']}\n"
+        )
+        if options["hedge"]:
+            f.write("[http]\nhedge_stages = [\"title\", \"title_fix\"]\n")
+    shutil.copy(os.path.join(ROOT, "replacement_dict.json"), workdir)
+    return workdir
+
+
+def run_case(server, mode, rows, options):
+    path = fixture_path(rows, options["unique_ratio"])
+    workdir = prepare_workdir(server, options)
+    server.stats.reset()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    try:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", mode, path, json.dumps(options)],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    wall = time.perf_counter() - start
+    if output.returncode != 0:
+        raise RuntimeError(f"{mode} {rows}行で失敗しました:\n{output.stderr[-2000:]}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    stats = server.stats.as_dict()
+    return {
+        "mode": mode,
+        "rows": rows,
+        "wall_s": wall,
+        "elapsed_s": result["elapsed_s"],
+        "rows_per_s": result["rows"] / result["elapsed_s"] if result["elapsed_s"] else 0.0,
+        "calls_per_row": stats["requests"] / rows,
+        "rate_limited": stats["rate_limited"],
+        "retries": result["counters"].get("retries", 0),
+        "dedup_saved": result["counters"].get("dedup_saved", 0),
+        "hedged_requests": result["counters"].get("hedged_requests", 0),
+        "hedge_wins": result["counters"].get("hedge_wins", 0),
+        "error_rows": result["error_rows"],
+        "output_rows": result["output_rows"],
+        "stage_p99_s": result["stage_p99_s"],
+        "peak_rss_mb": result["peak_rss_mb"]
+    }
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3], json.loads(sys.argv[4]))
+        return
+
+    parser = argparse.ArgumentParser(description="モックAPIを使って各モードのスループットを計測します（API料金はかかりません）")
+    parser.add_argument("--modes", nargs="*", choices=MODES, default=MODES)
+    parser.add_argument("--rows", type=int, nargs="*", default=[100])
+    parser.add_argument("--unique-ratio", type=float, default=0.3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--variations", type=int, default=3)
+    parser.add_argument("--packed", action="store_true", help="業務分割で複数行をまとめて送る")
+    parser.add_argument("--multi", action="store_true", help="言い換え複製でバリエーションを一括生成する")
+    parser.add_argument("--hedge", action="store_true", help="職種名の遅い呼び出しをヘッジする")
+    parser.add_argument("--latency-median", type=float, default=0.2)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429を返す割合")
+    parser.add_argument("--rpm", type=int, default=100000)
+    parser.add_argument("--tpm", type=int, default=100000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    options = {
+        "concurrency": args.concurrency, "variations": args.variations, "packed": args.packed, "multi": args.multi,
+        "unique_ratio": args.unique_ratio, "rpm": args.rpm, "tpm": args.tpm, "hedge": args.hedge
+    }
+    results = []
+    with MockOpenAIServer(latency_median=args.latency_median, latency_sigma=args.latency_sigma,
+                          error_rate=args.error_rate, seed=args.seed) as server:
+        print(f"{'mode':<11}{'rows':>8}{'秒':>9}{'行/秒':>9}{'呼出/行':>9}{'429':>6}{'重複省略':>9}{'ヘッジ':>7}{'エラー行':>8}{'RSS(MB)':>9}")
+        for rows in args.rows:
+            for mode in args.modes:
+                r = run_case(server, mode, rows, options)
+                results.append(r)
+                print(f"{r['mode']:<11}{r['rows']:>8}{r['elapsed_s']:>9.2f}{r['rows_per_s']:>9.1f}{r['calls_per_row']:>9.2f}"
+                      f"{r['rate_limited']:>6}{r['dedup_saved']:>9}{r['hedged_requests']:>7}{r['error_rows']:>8}{r['peak_rss_mb']:>9.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"options": options, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
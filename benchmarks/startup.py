@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["openai", "fugashi", "pandas", "openpyxl"]
+
+# 新しいプロセスで app.py を1回描画し、所要時間と読み込まれた重いモジュールを出力する
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file("app.py", default_timeout=60)
+at.secrets["openai"] = {"api_key": "sk-benchmark"}
+at.run()
+done = time.perf_counter()
+print(json.dumps({
+    "streamlit_import_s": imported - start,
+    "first_render_s": done - imported,
+    "exceptions": [str(e.value) for e in at.exception],
+    "loaded": [name for name in %r if name in sys.modules]
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_once():
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# --- 起動時間のベンチマーク（初回描画までの時間が上限を超えたら終了コード1） ---
+def main():
+    parser = argparse.ArgumentParser(description="アプリの初回描画までの時間を計測します")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None, help="初回描画時間（中央値）の上限")
+    parser.add_argument("--forbid", nargs="*", default=["openai", "fugashi"],
+                        help="初回描画で読み込まれてはいけないモジュール")
+    args = parser.parse_args()
+
+    results = [measure_once() for _ in range(args.runs)]
+    renders = [r["first_render_s"] for r in results]
+    loaded = sorted({name for r in results for name in r["loaded"]})
+    exceptions = [e for r in results for e in r["exceptions"]]
+    median = statistics.median(renders)
+
+    print(f"初回描画: 中央値 {median:.3f}s / 最小 {min(renders):.3f}s / 最大 {max(renders):.3f}s（{args.runs}回）")
+    print(f"streamlit読み込み: 中央値 {statistics.median(r['streamlit_import_s'] for r in results):.3f}s")
+    print(f"読み込まれた重いモジュール: {', '.join(loaded) or 'なし'}")
+
+    failed = False
+    if exceptions:
+        print(f"✗ 描画中に例外が発生しました: {exceptions[0]}")
+        failed = True
+    forbidden = [name for name in args.forbid if name in loaded]
+    if forbidden:
+        print(f"✗ 起動時に読み込まれています: {', '.join(forbidden)}")
+        failed = True
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f"✗ 初回描画が上限 {args.max_seconds:.3f}s を超えました")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
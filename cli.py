@@ -0,0 +1,125 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from excel_io import EXPORT_FORMATS, export_bytes
+from llm_engine import DEFAULT_CONCURRENCY
+from openai_client import HEDGE_STAGES
+from pipelines import MODES, estimate_pipeline, read_frame, run_pipeline
+from rate_limiter import DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from settings import configure, get_settings
+
+# --- コマンドライン実行（cronや大きなマシンで、フォルダ内のExcelをまとめて処理する） ---
+
+def init_worker(overrides):
+    configure(**overrides)
+
+
+def process_file(mode, path, output_path, options, resume, fmt="xlsx"):
+    journal = job_id = None
+    if resume:
+        from job_journal import JobJournal, journal_path
+        with open(path, "rb") as f:
+            file_bytes = f.read()
+        journal = JobJournal(journal_path())
+        job_id = journal.make_job_id(f"cli_{mode}", file_bytes, options)
+        journal.start(job_id, f"cli_{mode}", os.path.basename(path), options)
+    start = time.time()
+    result = run_pipeline(mode, path, journal=journal, job_id=job_id, **options)
+    with open(output_path, "wb") as f:
+        f.write(export_bytes(result, fmt))
+    return {"rows": result.row_count, "errors": result.error_count, "seconds": time.time() - start}
+
+
+def collect_inputs(source, pattern):
+    if os.path.isfile(source):
+        return [source]
+    # Excelが開いているときにできる一時ファイル（~$で始まる）は除く
+    return sorted(path for path in glob.glob(os.path.join(source, pattern))
+                  if not os.path.basename(path).startswith("~$"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="求人支援AIツールの処理を画面なしで実行します")
+    parser.add_argument("mode", choices=list(MODES))
+    parser.add_argument("source", help="Excelファイル、またはExcelファイルを含むフォルダ")
+    parser.add_argument("--output-dir", help="出力先フォルダ（省略時は入力フォルダ内の output）")
+    parser.add_argument("--pattern", default="*.xlsx")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="xlsx", help="出力形式")
+    parser.add_argument("--workers", type=int, default=4, help="同時に処理するファイル数（プロセス数）")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="1プロセスあたりの同時リクエスト数")
+    parser.add_argument("--variations", type=int, default=3, help="複製数（言い換えモード）")
+    parser.add_argument("--packed", action="store_true", help="業務分割で複数行をまとめて送る")
+    parser.add_argument("--multi", action="store_true", help="言い換えでバリエーションを一括生成する")
+    parser.add_argument("--share-variations", action="store_true", help="同じ内容の行には同じ複製を使う（API呼び出しを節約）")
+    parser.add_argument("--no-regenerate-similar", action="store_true", help="元の職種名（rewrite_pr ではキャッチコピーも）や他の複製とほぼ同じ複製も作り直さない")
+    parser.add_argument("--resume", action="store_true", help="中断したファイルを続きから再開する")
+    parser.add_argument("--requests-per-minute", type=int, help="アカウント全体のRPM上限（プロセス数で等分する）")
+    parser.add_argument("--tokens-per-minute", type=int, help="アカウント全体のTPM上限（プロセス数で等分する）")
+    parser.add_argument("--base-url", help="互換APIのURL")
+    parser.add_argument("--estimate", action="store_true", help="処理せずに呼び出し回数・トークン数・料金・所要時間の見積もりだけを表示する")
+    parser.add_argument("--hedge", action="store_true", help="遅い職種名の呼び出しに同じ依頼をもう1本送る")
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.source, args.pattern)
+    if not inputs:
+        print(f"処理するファイルがありません: {args.source}", file=sys.stderr)
+        return 1
+    source_dir = args.source if os.path.isdir(args.source) else os.path.dirname(os.path.abspath(args.source))
+    output_dir = args.output_dir or os.path.join(source_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # レート制限はアカウント単位なので、各プロセスにはその一部だけを割り当てる
+    workers = max(1, min(args.workers, len(inputs)))
+    openai_settings = get_settings("openai")
+    rpm = args.requests_per_minute or openai_settings.get("requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE)
+    tpm = args.tokens_per_minute or openai_settings.get("tokens_per_minute", DEFAULT_TOKENS_PER_MINUTE)
+    overrides = {"openai": {"requests_per_minute": max(1, rpm // workers), "tokens_per_minute": max(1, tpm // workers)}}
+    if args.base_url:
+        overrides["openai"]["base_url"] = args.base_url
+    if args.hedge:
+        overrides["http"] = {"hedge_stages": list(HEDGE_STAGES)}
+
+    _, _, takes_variations, allowed = MODES[args.mode]
+    options = {"concurrency": args.concurrency}
+    if takes_variations:
+        options["num_variations"] = args.variations
+    flags = {"packed": args.packed, "multi": args.multi, "share_variations": args.share_variations,
+             "regenerate_similar": not args.no_regenerate_similar}
+    options.update({name: value for name, value in flags.items() if name in allowed})
+
+    if args.estimate:
+        configure(**overrides)
+        for path in inputs:
+            # 見積もりには全プロセス合計の同時リクエスト数を使う
+            flags = {name: value for name, value in options.items() if name in allowed}
+            estimate = estimate_pipeline(args.mode, read_frame(path), args.variations, args.concurrency * workers, **flags).as_dict()
+            print(f"{path}: {estimate['rows']}行・呼び出し {estimate['calls']}回・トークン "
+                  f"{estimate['prompt_tokens'] + estimate['completion_tokens']}・${estimate['estimated_cost_usd']:.2f}"
+                  f"・約{estimate['estimated_seconds'] / 60:.0f}分")
+        return 0
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(overrides,)) as pool:
+        futures = {}
+        for path in inputs:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            output_path = os.path.join(output_dir, f"{stem}_{args.mode}.{args.format}")
+            futures[pool.submit(process_file, args.mode, path, output_path, options, args.resume, args.format)] = (path, output_path)
+        for future in as_completed(futures):
+            path, output_path = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"✗ {path}: {e}", file=sys.stderr)
+                continue
+            note = f"・エラー {summary['errors']}行" if summary["errors"] else ""
+            print(f"✓ {path} → {output_path}（{summary['rows']}行{note}・{summary['seconds']:.1f}秒）")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import csv
+import hashlib
+import itertools
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from io import BytesIO, StringIO
+
+CHUNK_SIZE = 500
+PREVIEW_ROWS = 10
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+_CLEAN_PATTERN = re.compile(r"_x000D_|\r|\n")
+
+EXPORT_FORMATS = {
+    "xlsx": ("Excel", XLSX_MIME),
+    "csv": ("CSV", "text/csv"),
+    "parquet": ("Parquet", "application/vnd.apache.parquet"),
+}
+EXPORT_CACHE_SIZE = 8
+
+# data は書き出し済みのxlsx、fingerprint は結果ごとに変わる識別子
+ExcelResult = namedtuple("ExcelResult", ["preview", "data", "row_count", "error_count", "fingerprint"])
+
+# pandas / openpyxl は読み込みに時間がかかるため、実際に使う時点で import する
+
+# --- セルの整形（使用する2列だけを対象にする） ---
+def clean_cell(value):
+    if value is None:
+        # pandas経由で読み込んでいた頃と同じく、空セルは "nan" として扱う
+        return "nan"
+    return _CLEAN_PATTERN.sub("", str(value))
+
+
+# --- ストリーミング読み込み（openpyxl read-only） ---
+class ExcelChunkReader:
+    def __init__(self, file, num_columns=2, metrics=None):
+        self.file = file
+        self.num_columns = num_columns
+        self.metrics = metrics
+        self.columns = self._read_header()
+
+    def _open(self):
+        self.file.seek(0)
+        from openpyxl import load_workbook
+        return load_workbook(self.file, read_only=True, data_only=True)
+
+    def _read_header(self):
+        workbook = self._open()
+        try:
+            header = next(workbook.worksheets[0].iter_rows(max_row=1, max_col=self.num_columns, values_only=True), ())
+        finally:
+            workbook.close()
+        header = list(header) + [None] * (self.num_columns - len(header))
+        return [str(name) if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+
+    def iter_rows(self):
+        workbook = self._open()
+        try:
+            for values in workbook.worksheets[0].iter_rows(min_row=2, max_col=self.num_columns, values_only=True):
+                values = list(values) + [None] * (self.num_columns - len(values))
+                # 書式だけが残った空行は読み飛ばす
+                if all(value is None for value in values):
+                    continue
+                yield tuple(clean_cell(value) for value in values)
+        finally:
+            workbook.close()
+
+    def count_rows(self):
+        # 進捗表示用の総行数。シートの寸法情報が無い場合は実際に数える
+        workbook = self._open()
+        try:
+            max_row = workbook.worksheets[0].max_row
+        finally:
+            workbook.close()
+        if max_row is not None:
+            return max(max_row - 1, 0)
+        return sum(1 for _ in self.iter_rows())
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        rows = self.iter_rows()
+        while True:
+            # 読み込みと整形にかかった時間だけを計測する（呼び出し側の処理時間は含めない）
+            start = time.perf_counter()
+            chunk = list(itertools.islice(rows, chunk_size))
+            if self.metrics is not None:
+                self.metrics.record("excel_read", time.perf_counter() - start)
+            if not chunk:
+                return
+            yield chunk
+
+    def preview(self, n=5):
+        rows = []
+        for row in self.iter_rows():
+            if len(rows) >= n:
+                break
+            rows.append(row)
+        import pandas as pd
+        return pd.DataFrame(rows, columns=self.columns)
+
+
+# --- ストリーミング書き出し（openpyxl write-only） ---
+class StreamingExcelWriter:
+    def __init__(self, columns, preview_rows=PREVIEW_ROWS, metrics=None):
+        self.columns = list(columns)
+        self.preview_rows = preview_rows
+        self.metrics = metrics
+        self.row_count = 0
+        self.error_count = 0
+        self._preview = []
+        from openpyxl import Workbook
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet()
+        self._sheet.append(self.columns)
+
+    def append_rows(self, rows):
+        start = time.perf_counter()
+        for row in rows:
+            values = [row[column] for column in self.columns]
+            self._sheet.append(values)
+            if any(isinstance(value, str) and value.startswith("[ERROR]") for value in values):
+                self.error_count += 1
+            if len(self._preview) < self.preview_rows:
+                self._preview.append(values)
+        self.row_count += len(rows)
+        if self.metrics is not None:
+            self.metrics.record("excel_write", time.perf_counter() - start)
+
+    def close(self):
+        import pandas as pd
+        start = time.perf_counter()
+        output = BytesIO()
+        self._workbook.save(output)
+        if self.metrics is not None:
+            self.metrics.record("excel_save", time.perf_counter() - start)
+        data = output.getvalue()
+        return ExcelResult(
+            preview=pd.DataFrame(self._preview, columns=self.columns),
+            data=data,
+            row_count=self.row_count,
+            error_count=self.error_count,
+            fingerprint=hashlib.sha256(data).hexdigest()[:16]
+        )
+
+
+# --- 出力形式の変換（要求された形式だけを作り、結果が変わるまで使い回す） ---
+def iter_result_rows(result):
+    # 書き出し済みのxlsxを read-only で1行ずつ読み直す（見出し行を含む）。
+    # 書き出し中は行を手元に残さないため、処理中のメモリ使用量は入力サイズに関係なく一定になる
+    from openpyxl import load_workbook
+    workbook = load_workbook(BytesIO(result.data), read_only=True, data_only=False)
+    try:
+        for values in workbook.worksheets[0].iter_rows(values_only=True):
+            yield ["" if value is None else value for value in values]
+    finally:
+        workbook.close()
+
+
+_export_cache = OrderedDict()
+_export_lock = threading.Lock()
+
+def export_bytes(result, fmt):
+    if fmt == "xlsx":
+        return result.data
+    key = (result.fingerprint, fmt)
+    with _export_lock:
+        if key in _export_cache:
+            _export_cache.move_to_end(key)
+            return _export_cache[key]
+    if fmt == "csv":
+        # Excelで文字化けしないようにBOM付きUTF-8にする
+        output = StringIO()
+        csv.writer(output).writerows(iter_result_rows(result))
+        data = ("\ufeff" + output.getvalue()).encode("utf-8")
+    elif fmt == "parquet":
+        import pandas as pd
+        rows = iter_result_rows(result)
+        header = next(rows)
+        # CSVと同じく全ての列を文字列として保存する
+        frame = pd.DataFrame(list(rows), columns=header).astype(str)
+        output = BytesIO()
+        frame.to_parquet(output, index=False)
+        data = output.getvalue()
+    else:
+        raise ValueError(f"未対応の出力形式です: {fmt}")
+    with _export_lock:
+        _export_cache[key] = data
+        while len(_export_cache) > EXPORT_CACHE_SIZE:
+            _export_cache.popitem(last=False)
+    return data
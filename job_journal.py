@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from settings import get_settings
+
+DEFAULT_JOURNAL_PATH = os.path.join(".cache", "jobs.sqlite3")
+KEEP_FINISHED_DAYS = 7
+
+# --- ジョブジャーナル（行ごとの処理結果を永続化して再開できるようにする） ---
+class JobJournal:
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                mode TEXT NOT NULL,
+                file_name TEXT,
+                settings TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_rows (
+                job_id TEXT NOT NULL,
+                row_index INTEGER NOT NULL,
+                rows TEXT NOT NULL,
+                PRIMARY KEY (job_id, row_index)
+            )
+        """)
+        # バッチモードで送信したバッチ（再開時に送り直さず、同じバッチの完了を待つため）
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_batches (
+                job_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                batch_id TEXT NOT NULL,
+                PRIMARY KEY (job_id, name)
+            )
+        """)
+        self._conn.commit()
+        self.purge_finished()
+
+    @staticmethod
+    def make_job_id(mode, file_bytes, settings):
+        # 同じファイル・同じ設定なら同じジョブIDになるため、再アップロードで再開できる
+        digest = hashlib.sha256()
+        digest.update(mode.encode("utf-8"))
+        digest.update(file_bytes)
+        digest.update(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return digest.hexdigest()[:32]
+
+    def start(self, job_id, mode, file_name, settings):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO jobs (job_id, mode, file_name, settings, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'running', ?, ?)
+                ON CONFLICT(job_id) DO UPDATE SET status = 'running', updated_at = excluded.updated_at
+            """, (job_id, mode, file_name, json.dumps(settings, ensure_ascii=False), now, now))
+            self._conn.commit()
+
+    def finish(self, job_id):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'finished', updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+            self._conn.commit()
+
+    def reset(self, job_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM job_rows WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM job_batches WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self._conn.commit()
+
+    def record(self, job_id, row_index, rows):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_rows (job_id, row_index, rows) VALUES (?, ?, ?)",
+                (job_id, row_index, json.dumps(rows, ensure_ascii=False))
+            )
+            self._conn.commit()
+
+    def load_rows(self, job_id, start, end):
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT row_index, rows FROM job_rows WHERE job_id = ? AND row_index >= ? AND row_index < ?",
+                (job_id, start, end)
+            )
+            return {row_index: json.loads(rows) for row_index, rows in cursor}
+
+    def record_batch(self, job_id, name, batch_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_batches (job_id, name, batch_id) VALUES (?, ?, ?)",
+                (job_id, name, batch_id)
+            )
+            self._conn.commit()
+
+    def load_batches(self, job_id):
+        with self._lock:
+            cursor = self._conn.execute("SELECT name, batch_id FROM job_batches WHERE job_id = ?", (job_id,))
+            return dict(cursor.fetchall())
+
+    def count_rows(self, job_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM job_rows WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def purge_finished(self, older_than_days=KEEP_FINISHED_DAYS):
+        cutoff = time.time() - older_than_days * 24 * 3600
+        with self._lock:
+            for table in ("job_rows", "job_batches"):
+                self._conn.execute(
+                    f"DELETE FROM {table} WHERE job_id IN (SELECT job_id FROM jobs WHERE status = 'finished' AND updated_at < ?)",
+                    (cutoff,)
+                )
+            self._conn.execute("DELETE FROM jobs WHERE status = 'finished' AND updated_at < ?", (cutoff,))
+            self._conn.commit()
+
+
+def journal_path():
+    return get_settings("jobs").get("journal_path", DEFAULT_JOURNAL_PATH)
+
+
+def has_error(rows):
+    return any(isinstance(value, str) and value.startswith("[ERROR]") for row in rows for value in row.values())
+
+
+async def run_chunk(chunk, offset, process_row, journal=None, job_id=None, on_row_done=None, grouped=False):
+    # 処理済みの行はジャーナルから復元し、未処理の行だけをAIに送る
+    done = journal.load_rows(job_id, offset, offset + len(chunk)) if journal is not None else {}
+
+    async def run_row(index, row):
+        if index in done:
+            rows = done[index]
+        else:
+            rows = await process_row(*row)
+            # エラーを含む行は記録せず、再開時にやり直す
+            if journal is not None and not has_error(rows):
+                journal.record(job_id, index, rows)
+        if on_row_done is not None:
+            on_row_done(rows)
+        return rows
+
+    # asyncio.gatherは入力順に結果を返すため、出力行の順序は逐次処理と同じになる
+    tasks = [asyncio.ensure_future(run_row(offset + i, row)) for i, row in enumerate(chunk)]
+    try:
+        row_results = await asyncio.gather(*tasks)
+    except BaseException:
+        # キャンセルなどで1行が失敗したら、残りの行も止めてから送出する（止めないと呼び出しが続く）
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    # grouped=True なら、元の行ごとの出力行のリストのまま返す
+    if grouped:
+        return row_results
+    return [row for rows in row_results for row in rows]
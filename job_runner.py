@@ -0,0 +1,436 @@
+import csv
+import hashlib
+import io
+import math
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import streamlit as st
+from excel_io import EXPORT_FORMATS, export_bytes
+from job_journal import JobJournal, journal_path
+from metrics import Metrics
+from settings import get_settings
+
+DEFAULT_MAX_WORKERS = 4
+POLL_INTERVAL = 2
+KEEP_JOBS = 50
+ACTIVE_STATUSES = ("queued", "running")
+RATE_WINDOW = 60
+RECENT_ROWS = 20
+FRAME_CACHE_SIZE = 2
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobAlreadyRunning(Exception):
+    pass
+
+
+# --- 途中経過の結果（完了した行から順にCSVへ書き足し、途中でもダウンロードできるようにする） ---
+class PartialResults:
+    def __init__(self, recent_rows=RECENT_ROWS):
+        self.row_count = 0
+        # 完了した行はメモリではなく一時ファイルに書き足す（ジョブを手放すと削除される）
+        self._buffer = io.TextIOWrapper(tempfile.TemporaryFile(), encoding="utf-8-sig", newline="")
+        self._writer = None
+        self._recent = deque(maxlen=recent_rows)
+        self._lock = threading.Lock()
+
+    def append(self, rows):
+        if not rows:
+            return
+        with self._lock:
+            if self._buffer is None:
+                return
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._buffer, fieldnames=list(rows[0]), extrasaction="ignore")
+                self._writer.writeheader()
+            self._writer.writerows(rows)
+            self._recent.extend(rows)
+            self.row_count += len(rows)
+
+    def recent(self):
+        # 新しい行が先頭に来るように返す
+        with self._lock:
+            return list(reversed(self._recent))
+
+    @property
+    def available(self):
+        return self._buffer is not None
+
+    def csv_bytes(self):
+        # Excelで文字化けしないようにBOM付きUTF-8で返す（書き込み位置は末尾に戻す）
+        with self._lock:
+            if self._buffer is None:
+                return b""
+            self._buffer.flush()
+            raw = self._buffer.buffer
+            raw.seek(0)
+            data = raw.read()
+            raw.seek(0, io.SEEK_END)
+            return data
+
+    def release(self):
+        # ジョブが終わったら書き足してきたCSVを手放す（表示用の直近の行だけ残す）
+        with self._lock:
+            if self._buffer is not None:
+                self._buffer.close()
+            self._buffer = None
+            self._writer = None
+
+
+def format_eta(seconds):
+    if seconds < 60:
+        return f"{int(seconds)}秒"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}分"
+    return f"{int(seconds // 3600)}時間{int(seconds % 3600 // 60)}分"
+
+
+# --- ジョブの状態 ---
+class Job:
+    def __init__(self, mode, file_name, journal_id=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.file_name = file_name
+        # ジョブジャーナルのID（同じファイル・同じ設定なら同じになる）
+        self.journal_id = journal_id
+        self.status = "queued"
+        self.done_rows = 0
+        self.total_rows = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.metrics = Metrics()
+        self.partial = PartialResults()
+        self._cancel = threading.Event()
+        self._rate_samples = deque()
+
+    def report(self, done_rows, total_rows=None, rows=None):
+        # パイプラインから進捗（と完了した行）を受け取る。キャンセル済みならここで処理を打ち切る
+        self.done_rows = done_rows
+        if total_rows is not None:
+            self.total_rows = total_rows
+        if rows:
+            self.partial.append(rows)
+        now = time.monotonic()
+        self._rate_samples.append((now, done_rows))
+        while len(self._rate_samples) > 2 and self._rate_samples[1][0] < now - RATE_WINDOW:
+            self._rate_samples.popleft()
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def progress(self):
+        if not self.total_rows:
+            return 0.0
+        return min(self.done_rows / self.total_rows, 1.0)
+
+    @property
+    def eta_seconds(self):
+        # 直近 RATE_WINDOW 秒の処理速度から残り時間を見積もる（再開時に復元した行の分で速く見えすぎないように）
+        if not self.total_rows or len(self._rate_samples) < 2:
+            return None
+        (start, start_done), (end, end_done) = self._rate_samples[0], self._rate_samples[-1]
+        if end <= start or end_done <= start_done:
+            return None
+        rate = (end_done - start_done) / (end - start)
+        return max(self.total_rows - self.done_rows, 0) / rate
+
+
+class ProgressCounter:
+    def __init__(self, total_rows, on_progress=None, metrics=None):
+        self.total_rows = total_rows
+        self.done_rows = 0
+        self.on_progress = on_progress
+        self.metrics = metrics
+        if on_progress is not None:
+            on_progress(0, total_rows)
+
+    def advance(self, rows=None):
+        self.done_rows += 1
+        if self.metrics is not None:
+            self.metrics.incr("rows")
+        if self.on_progress is not None:
+            self.on_progress(self.done_rows, self.total_rows, rows)
+
+
+# --- バックグラウンド実行（Streamlitの再実行から切り離す） ---
+class JobRunner:
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, mode, file_name, target, *args, **kwargs):
+        # target は on_progress=(done, total, 完了した行) と metrics を受け取り、結果を返す関数。
+        # 同じジャーナル（job_id）のジョブが実行中なら、同じ行を二重に処理しないよう投入しない
+        job = Job(mode, file_name, kwargs.get("job_id"))
+        with self._lock:
+            if job.journal_id is not None and self._find_active(job.journal_id) is not None:
+                raise JobAlreadyRunning(f"同じファイル・同じ設定のジョブが実行中です（ジョブID {job.journal_id[:8]}）")
+            self._jobs[job.id] = job
+            self._trim()
+        self._executor.submit(self._run, job, target, args, kwargs)
+        return job.id
+
+    def _run(self, job, target, args, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = target(*args, on_progress=job.report, metrics=job.metrics, **kwargs)
+            job.status = "finished"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.error = f"{e}\n{traceback.format_exc()}"
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            job.metrics.finish()
+            # 終了したジョブは KEEP_JOBS 件まで残るため、途中経過のCSVはここで手放す
+            # （完了した場合は結果に、中止・失敗した場合はジャーナルに同じ行がある）
+            job.partial.release()
+
+    def _trim(self):
+        # 終了済みジョブは古いものから破棄する
+        finished = [job for job in self._jobs.values() if job.status not in ACTIVE_STATUSES]
+        for job in sorted(finished, key=lambda j: j.created_at)[:max(len(self._jobs) - KEEP_JOBS, 0)]:
+            del self._jobs[job.id]
+
+    def _find_active(self, journal_id):
+        return next((job for job in self._jobs.values() if job.journal_id == journal_id and job.status in ACTIVE_STATUSES), None)
+
+    def find_active(self, journal_id):
+        with self._lock:
+            return self._find_active(journal_id)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+
+@st.cache_resource(show_spinner=False)
+def get_shared_runner():
+    # ワーカープールはプロセス内で1つだけ持ち、全セッションで共有する。
+    # st.cache_resource に置くことで、ソース変更によるモジュールの再読み込みでも実行中のジョブを見失わない
+    return JobRunner(get_settings("jobs").get("max_workers", DEFAULT_MAX_WORKERS))
+
+
+# --- ジョブジャーナル（画面側） ---
+@st.cache_resource(show_spinner=False)
+def get_shared_journal():
+    # 画面側からだけ呼ばれるので、再実行やモジュールの再読み込みをまたいで st.cache_resource で共有する
+    return JobJournal(journal_path())
+
+
+def prepare_job(mode, file_bytes, file_name, settings, resume):
+    journal = get_shared_journal()
+    job_id = journal.make_job_id(mode, file_bytes, settings)
+    # 実行中のジョブと同じジャーナルは使わない（resume=False なら処理中の行を消してしまう）
+    if get_shared_runner().find_active(job_id) is not None:
+        raise JobAlreadyRunning(f"同じファイル・同じ設定のジョブが実行中です（ジョブID {job_id[:8]}）")
+    if not resume:
+        journal.reset(job_id)
+    journal.start(job_id, mode, file_name, settings)
+    return journal, job_id
+
+
+def show_resume_info(journal, job_id):
+    done = journal.count_rows(job_id)
+    if done:
+        st.info(f"♻ 前回の続きから再開します（{done}行処理済み・ジョブID {job_id[:8]}）")
+    batches = journal.load_batches(job_id)
+    if batches:
+        st.info(f"♻ 前回送信したバッチ（{len(batches)}件）を引き継ぎ、使えるものは送り直さずに完了を待ちます（ジョブID {job_id[:8]}）")
+
+
+def is_job_active(job_key):
+    # このセッションのジョブが待機中・実行中なら、開始ボタンを押せないようにする
+    job_id = st.session_state.get(job_key)
+    job = get_shared_runner().get(job_id) if job_id else None
+    active = job is not None and job.status in ACTIVE_STATUSES
+    st.session_state[f"{job_key}_active"] = active
+    return active
+
+
+class StartButton:
+    # 開始ボタン。このセッションのジョブが待機中・実行中の間は押せない（同じジョブの二重投入を防ぐ）
+    def __init__(self, job_key, label="処理を開始する"):
+        self.job_key = job_key
+        self.label = label
+        self._slot = st.empty()
+        self.clicked = self._slot.button(label, disabled=is_job_active(job_key), key=f"{job_key}_start")
+
+    def started(self):
+        # 投入した直後の画面でも押せないよう、同じ場所にボタンを無効にして描き直す
+        st.session_state[f"{self.job_key}_active"] = True
+        self._slot.button(self.label, disabled=True, key=f"{self.job_key}_started")
+
+
+# --- 実行前の見積もり ---
+_frame_cache = OrderedDict()
+_frame_lock = threading.Lock()
+
+def load_frame(file_bytes):
+    # 設定を変えるたびに読み直さないよう、同じファイルの読み込み結果を使い回す
+    key = hashlib.sha256(file_bytes).hexdigest()
+    with _frame_lock:
+        if key in _frame_cache:
+            _frame_cache.move_to_end(key)
+            return _frame_cache[key]
+    from pipelines import read_frame
+    with st.spinner("ファイル全体を読み込んでいます..."):
+        frame = read_frame(file_bytes)
+    with _frame_lock:
+        _frame_cache[key] = frame
+        while len(_frame_cache) > FRAME_CACHE_SIZE:
+            _frame_cache.popitem(last=False)
+    return frame
+
+
+def render_estimate(mode, file_bytes, num_variations=3, concurrency=None, **options):
+    # 「処理を開始する」を押す前に、呼び出し回数・トークン数・料金・所要時間の目安を表示する
+    from pipelines import estimate_pipeline
+    estimate = estimate_pipeline(mode, load_frame(file_bytes), num_variations, concurrency, **options).as_dict()
+    minutes = math.ceil(estimate["estimated_seconds"] / 60)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("API呼び出し（見込み）", f"{estimate['calls']:,}回")
+    col2.metric("トークン（見込み）", f"{estimate['prompt_tokens'] + estimate['completion_tokens']:,}",
+                f"入力 {estimate['prompt_tokens']:,}", delta_color="off")
+    col3.metric("推定コスト", f"${estimate['estimated_cost_usd']:.2f}")
+    col4.metric("所要時間（目安）", f"約{minutes}分")
+    st.caption("※ 同じ内容の行はまとめて数えています。キャッシュ済みの応答は含めていないため、実際はこれより少なくなることがあります。")
+
+
+# --- 計測パネル ---
+def render_metrics(metrics, key, exportable=False):
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    with st.expander("📊 処理時間・コストの計測", expanded=False):
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("スループット", f"{snapshot['rows_per_minute']:.1f} 行/分")
+        col2.metric("API呼び出し", f"{counters.get('api_calls', 0)}回", f"再試行 {counters.get('retries', 0)}回", delta_color="off")
+        col3.metric("キャッシュヒット", f"{counters.get('cache_hits', 0)}件", f"重複まとめ {counters.get('dedup_saved', 0)}件", delta_color="off")
+        col4.metric("推定コスト", f"${snapshot['estimated_cost_usd']:.4f}", f"${snapshot['cost_per_row_usd']:.5f}/行", delta_color="off")
+        st.caption(f"トークン: 入力 {counters.get('prompt_tokens', 0)} / 出力 {counters.get('completion_tokens', 0)}")
+        st.dataframe([
+            {"段階": stage, "回数": v["count"], "平均(秒)": round(v["mean_s"], 3), "p50": round(v["p50_s"], 3),
+             "p95": round(v["p95_s"], 3), "p99": round(v["p99_s"], 3), "合計(秒)": round(v["total_s"], 2)}
+            for stage, v in sorted(snapshot["stages"].items())
+        ])
+        if exportable:
+            col1, col2 = st.columns(2)
+            col1.download_button("📥 計測結果（JSON）", metrics.to_json(), file_name="metrics.json", mime="application/json", key=f"{key}_json")
+            col2.download_button("📥 計測結果（CSV）", metrics.to_csv(), file_name="metrics.csv", mime="text/csv", key=f"{key}_csv")
+
+
+def render_job_status(job_key, result_key):
+    # 実行中はこの部分だけを定期的に再描画して進捗を表示し、完了したら結果をセッションに移す
+    metrics_key = f"{job_key}_metrics"
+
+    @st.fragment(run_every=POLL_INTERVAL)
+    def job_status():
+        job_id = st.session_state.get(job_key)
+        job = get_shared_runner().get(job_id) if job_id else None
+        if job is None:
+            # 直前に完了したジョブの計測結果を表示・書き出しできるようにする
+            if st.session_state.get(metrics_key) is not None:
+                render_metrics(st.session_state[metrics_key], job_key, exportable=True)
+            return
+        st.session_state[metrics_key] = job.metrics
+        if job.status in ACTIVE_STATUSES:
+            if job.total_rows:
+                eta = job.eta_seconds
+                eta_text = f"・残り約{format_eta(eta)}" if eta is not None else ""
+                st.progress(job.progress, text=f"⏳ {job.file_name}: {job.done_rows}/{job.total_rows}行 処理済み{eta_text}")
+            else:
+                st.info(f"⏳ {job.file_name}: 待機中（ジョブ {job.id}）")
+            if st.button("⏹ 処理を中止する", key=f"{job_key}_cancel"):
+                job.cancel()
+            render_partial_results(job, job_key)
+            render_metrics(job.metrics, job_key)
+            return
+        if st.session_state.get(f"{job_key}_active"):
+            # 開始ボタンを押せるように戻すため、ジョブが終わったら画面全体を再実行する
+            st.session_state[f"{job_key}_active"] = False
+            if job.status != "finished":
+                st.rerun()
+        render_metrics(job.metrics, job_key, exportable=True)
+        if job.status == "cancelled":
+            st.warning(f"処理を中止しました（{job.done_rows}行まで完了・再開すると続きから処理します）")
+            render_partial_results(job, job_key)
+            return
+        if job.status == "failed":
+            st.error(f"処理中にエラーが発生しました: {job.error.splitlines()[0]}")
+            render_partial_results(job, job_key)
+            return
+        st.session_state[job_key] = None
+        st.session_state[result_key] = job.result
+        # 結果はセッション側で持つので、ランナーに残る終了済みジョブからは外しておく
+        job.result = None
+        st.rerun()
+
+    job_status()
+
+
+def render_partial_results(job, job_key):
+    recent = job.partial.recent()
+    if not recent:
+        return
+    st.caption(f"完了した行（新しい順に{len(recent)}件を表示・ここまで {job.partial.row_count}件）")
+    st.dataframe(recent)
+    if not job.partial.available:
+        return
+    # データはボタンが押されたときにだけ作る（定期的な再描画のたびに結果全体を変換しない）
+    st.download_button(
+        label="📥 ここまでの結果をダウンロード（CSV・完了順）",
+        data=job.partial.csv_bytes,
+        file_name="partial_results.csv",
+        mime="text/csv",
+        key=f"{job_key}_partial",
+        on_click="ignore"
+    )
+
+
+def show_error_rows(result):
+    if result.error_count:
+        st.warning(
+            f"⚠ {result.error_count}行でエラーが発生しました。OpenAIの利用上限に達している場合は、"
+            "しばらく時間をおいて再実行してください（再開すると失敗した行だけをやり直します）。"
+        )
+
+
+def render_result_downloads(result, file_stem, key):
+    # xlsx はジョブ終了時に作成済み。CSV・Parquet はボタンが押されたときに変換し、結果ごとにキャッシュする
+    fmt = st.radio("出力形式", list(EXPORT_FORMATS), format_func=lambda f: EXPORT_FORMATS[f][0],
+                   horizontal=True, key=f"{key}_format")
+    label, mime = EXPORT_FORMATS[fmt]
+    st.download_button(
+        label=f"📥 結果をダウンロード（{label}）",
+        data=result.data if fmt == "xlsx" else (lambda: export_bytes(result, fmt)),
+        file_name=f"{file_stem}.{fmt}",
+        mime=mime,
+        key=f"{key}_download"
+    )
+
+
+def render_job_list(container):
+    jobs = get_shared_runner().list_jobs()
+    active = [job for job in jobs if job.status in ACTIVE_STATUSES]
+    container.caption(f"⚙ 実行中のジョブ: {len(active)}件（全体 {len(jobs)}件）")
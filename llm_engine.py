@@ -0,0 +1,392 @@
+import asyncio
+import time
+from rate_limiter import get_shared_limiter, is_retryable, retry_after_seconds, error_status
+from response_cache import cached_stages, get_shared_cache
+from metrics import Metrics
+from openai_client import http_settings, make_async_client, stage_timeout
+
+MODEL = "gpt-3.5-turbo"
+DEFAULT_CONCURRENCY = 8
+# 同じ入力の行に別の結果を返すとき、出現回数ごとに variation をこの幅でずらす
+OCCURRENCE_STRIDE = 1000
+# ヘッジの待ち時間（p95）は、この件数以上の応答時間が集まってから、この件数ごとに計算し直す
+HEDGE_MIN_SAMPLES = 20
+HEDGE_REFRESH = 20
+# 終わった呼び出しの結果は、この件数までジョブ全体（チャンクをまたいで）で使い回す
+SHARED_RESULTS_LIMIT = 20000
+
+def normalize_prompt(prompt):
+    # 空白の違いだけのプロンプトは同じ依頼として扱う
+    return " ".join(prompt.split())
+
+async def iter_lines(chunks):
+    # ストリームで届いた断片を、改行で区切れた行から順に返す
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+async def _prepend(first, chunks):
+    if first is not None:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+# --- 非同期LLM実行エンジン ---
+# 同時実行数をセマフォで制限しつつ、各タスクが前段の応答を受け取った時点で次の段へ進めるようにする
+class LLMEngine:
+    def __init__(self, client=None, concurrency=DEFAULT_CONCURRENCY, model=MODEL, limiter=None, cache=None, use_cache=True, metrics=None,
+                 share_variations=False, hedge_stages=None, cache_stages=None):
+        self._owns_client = client is None
+        if client is None:
+            # 接続プールとタイムアウトは openai_client の共通設定を使う
+            # （openai は import に時間がかかるので、実際に呼び出すジョブが始まるまで読み込まない）
+            client = make_async_client()
+        self.client = client
+        self.model = model
+        self.concurrency = concurrency
+        self.limiter = limiter if limiter is not None else get_shared_limiter()
+        if cache is None and use_cache:
+            cache = get_shared_cache()
+        self.cache = cache
+        # キャッシュを使う段（既定では analyze・describe など結果がほぼ決まっている段だけ）
+        self.cache_stages = set(cached_stages() if cache_stages is None else cache_stages)
+        self.metrics = metrics if metrics is not None else Metrics(model)
+        # バリエーションを作る段では、同じ入力の行にもそれぞれ別の結果を生成する。
+        # True にすると同じ入力の行には同じ結果を使い回す（呼び出しは減るが、重複した行の複製も同じになる）
+        self.share_variations = share_variations
+        # 指定した段では、p95 を過ぎても返らない呼び出しに同じ依頼をもう1本送る（既定では無効）。
+        # 追加で送る数は、そのジョブの呼び出し全体の hedge_budget の割合までに抑える
+        pool = http_settings()
+        self.hedge_stages = set(pool["hedge_stages"] if hedge_stages is None else hedge_stages)
+        self.hedge_budget = pool["hedge_budget"]
+        self._hedge_delays = {}
+        self._timeouts = {}
+        self._attempts = 0
+        self._hedges = 0
+        self._semaphore = None
+        self._loop = None
+        self._inflight = {}
+        self._occurrences = {}
+
+    @property
+    def semaphore(self):
+        # セマフォは実行中のイベントループ内で生成する（ループを閉じたら作り直す）
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def deduplicate(self, key, factory):
+        # 同じキーの処理が実行中・実行済みなら新しく呼び出さず、その結果を全ての行に配る
+        # （結果はエンジンを閉じるまで保持し、失敗した処理は後の行でやり直せるように外す）
+        task = self._inflight.get(key)
+        if task is not None:
+            self.metrics.incr("dedup_saved")
+        else:
+            task = asyncio.ensure_future(factory())
+            self._share(key, task)
+
+            def forget_failed(done):
+                if done.cancelled() or done.exception() is not None:
+                    self._inflight.pop(key, None)
+
+            task.add_done_callback(forget_failed)
+        return await asyncio.shield(task)
+
+    def _share(self, key, task):
+        # 上限を超えたら、終わったものから古い順に外す（実行中の処理は同じ依頼が待てるように残す）
+        self._inflight[key] = task
+        if len(self._inflight) <= SHARED_RESULTS_LIMIT:
+            return
+        excess = len(self._inflight) - SHARED_RESULTS_LIMIT
+        finished = []
+        for old_key, old_task in self._inflight.items():
+            if len(finished) >= excess:
+                break
+            if old_task.done():
+                finished.append(old_key)
+        for old_key in finished:
+            del self._inflight[old_key]
+
+    def _next_occurrence(self, prompt, temperature, variation):
+        key = (normalize_prompt(prompt), temperature, variation)
+        occurrence = self._occurrences.get(key, 0)
+        self._occurrences[key] = occurrence + 1
+        return variation + occurrence * OCCURRENCE_STRIDE
+
+    async def complete(self, prompt, temperature, variation=0, response_format=None, stage="llm", varied=False):
+        # 同じプロンプトは1回だけ呼び出し、結果を全ての行に配る。
+        # varied=True の段（バリエーション生成）は share_variations が False なら行ごとに別の結果にする
+        if varied and not self.share_variations:
+            variation = self._next_occurrence(prompt, temperature, variation)
+        key = (normalize_prompt(prompt), temperature, variation, repr(response_format))
+        return await self.deduplicate(key, lambda: self._complete(prompt, temperature, variation, response_format, stage))
+
+    async def _complete(self, prompt, temperature, variation, response_format, stage):
+        # 同じプロンプトから複数の異なる出力が欲しい場合は variation で区別してキャッシュする
+        cache_key = self._cache_key(prompt, temperature, variation, stage)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.metrics.incr("cache_hits")
+                return cached
+            self.metrics.incr("cache_misses")
+
+        estimated_tokens = self.limiter.estimate_tokens(prompt)
+        options = {"response_format": response_format} if response_format is not None else {}
+        timeout = self._timeout(stage)
+
+        def request():
+            return self.client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                timeout=timeout,
+                **options
+            )
+
+        attempt = 0
+        while True:
+            with self.metrics.timer("rate_limit_wait"):
+                await self.limiter.acquire(estimated_tokens)
+            try:
+                async with self.semaphore:
+                    with self.metrics.timer(f"llm:{stage}"):
+                        raw = await self._send(stage, request, estimated_tokens)
+                self.limiter.update_from_headers(raw.headers)
+                response = raw.parse()
+                usage = getattr(response, "usage", None)
+                self.limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+                self.metrics.add_usage(usage)
+                content = response.choices[0].message.content
+                if cache_key is not None and content is not None:
+                    self.cache.put(cache_key, content)
+                return content
+            except Exception as e:
+                await self._backoff(e, attempt)
+                attempt += 1
+
+    def _cache_key(self, prompt, temperature, variation, stage):
+        if self.cache is None or stage not in self.cache_stages:
+            return None
+        return self.cache.make_key(self.model, prompt, temperature, variation)
+
+    def _timeout(self, stage):
+        if stage not in self._timeouts:
+            self._timeouts[stage] = stage_timeout(stage)
+        return self._timeouts[stage]
+
+    def _hedge_delay(self, stage):
+        # 1回あたりの応答時間の p95 を過ぎたらヘッジする（サンプルが少ないうちは送らない）
+        if stage not in self.hedge_stages:
+            return None
+        cached = self._hedge_delays.get(stage)
+        if cached is None or self._attempts - cached[1] >= HEDGE_REFRESH:
+            p95, samples = self.metrics.quantile(f"llm:{stage}:attempt", 0.95)
+            cached = (p95 if samples >= HEDGE_MIN_SAMPLES else None, self._attempts)
+            self._hedge_delays[stage] = cached
+        return cached[0]
+
+    async def _attempt(self, stage, request):
+        # 再試行・ヘッジを含め、実際に送った1回ごとの応答時間を記録する
+        self._attempts += 1
+        self.metrics.incr("api_calls")
+        with self.metrics.timer(f"llm:{stage}:attempt"):
+            return await request()
+
+    async def _send(self, stage, request, estimated_tokens, discard=None):
+        # 遅い呼び出しには同じ依頼をもう1本送り、先に返った方を使う。
+        # 使わなかった方は取り消す（受信済みのストリームは discard で閉じる）
+        first = asyncio.ensure_future(self._attempt(stage, request))
+        delay = self._hedge_delay(stage)
+        if delay is None:
+            return await first
+        tasks = [first]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or self._hedges >= self.hedge_budget * self._attempts:
+                winner = first
+                return await first
+            self._hedges += 1
+            self.metrics.incr("hedged_requests")
+
+            async def hedge():
+                await self.limiter.acquire(estimated_tokens)
+                return await self._attempt(stage, request)
+
+            tasks.append(asyncio.ensure_future(hedge()))
+            pending = set(tasks)
+            while winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in tasks if task in done and task.exception() is None), None)
+                if winner is None and not pending:
+                    # 両方失敗した場合は、元の呼び出しのエラーとして再試行に回す
+                    raise first.exception()
+            if winner is not first:
+                self.metrics.incr("hedge_wins")
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled() and task.exception() is None and discard is not None:
+                    await discard(task.result())
+
+    async def _backoff(self, error, attempt):
+        # 再試行できないエラー・上限回数に達した場合はそのまま送出する
+        self.metrics.incr("api_errors")
+        if not is_retryable(error) or attempt >= self.limiter.max_retries:
+            raise error
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        self.limiter.update_from_headers(headers)
+        delay = self.limiter.backoff_delay(attempt, retry_after_seconds(headers))
+        if error_status(error) == 429:
+            self.limiter.block_for(delay)
+        self.metrics.incr("retries")
+        await asyncio.sleep(delay)
+
+    async def stream(self, prompt, temperature, variation=0, stage="llm", varied=False):
+        # 応答を届いた順に少しずつ返す。キャッシュ済み・同じ依頼が実行中の場合は全文をまとめて1回で返す
+        if varied and not self.share_variations:
+            variation = self._next_occurrence(prompt, temperature, variation)
+        key = (normalize_prompt(prompt), temperature, variation, repr(None))
+        task = self._inflight.get(key)
+        if task is not None:
+            self.metrics.incr("dedup_saved")
+            yield await asyncio.shield(task)
+            return
+
+        cache_key = self._cache_key(prompt, temperature, variation, stage)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.metrics.incr("cache_hits")
+                yield cached
+                return
+            self.metrics.incr("cache_misses")
+
+        # 同じ依頼が後から来た場合は、この応答の全文を待って受け取れるようにしておく
+        future = asyncio.get_running_loop().create_future()
+        self._share(key, future)
+        parts = []
+        try:
+            async for delta in self._stream(prompt, temperature, stage):
+                parts.append(delta)
+                yield delta
+        except BaseException as e:
+            self._inflight.pop(key, None)
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        content = "".join(parts)
+        future.set_result(content)
+        if cache_key is not None:
+            self.cache.put(cache_key, content)
+
+    async def _stream(self, prompt, temperature, stage):
+        estimated_tokens = self.limiter.estimate_tokens(prompt)
+        timeout = self._timeout(stage)
+
+        async def request():
+            raw = await self.client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=timeout
+            )
+            # 最初の断片が届くまでを1回の応答時間とする（ヘッジもこの時間で判断する）
+            chunks = raw.parse()
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await chunks.close()
+                raise
+            return raw, chunks, first
+
+        async def discard(opened):
+            await opened[1].close()
+
+        attempt = 0
+        while True:
+            with self.metrics.timer("rate_limit_wait"):
+                await self.limiter.acquire(estimated_tokens)
+            received = False
+            try:
+                async with self.semaphore:
+                    with self.metrics.timer(f"llm:{stage}"):
+                        start = time.perf_counter()
+                        raw, chunks, first = await self._send(stage, request, estimated_tokens, discard)
+                        self.limiter.update_from_headers(raw.headers)
+                        usage = None
+                        async for chunk in _prepend(first, chunks):
+                            usage = getattr(chunk, "usage", None) or usage
+                            delta = chunk.choices[0].delta.content if chunk.choices else None
+                            if delta:
+                                if not received:
+                                    self.metrics.record(f"llm:{stage}:first_token", time.perf_counter() - start)
+                                received = True
+                                yield delta
+                self.limiter.record_usage(estimated_tokens, getattr(usage, "total_tokens", None))
+                self.metrics.add_usage(usage)
+                return
+            except Exception as e:
+                # 途中まで返した後の失敗は、同じ内容を二重に返さないよう再試行しない
+                if received:
+                    self.metrics.incr("api_errors")
+                    raise
+                await self._backoff(e, attempt)
+                attempt += 1
+
+    def lookup(self, prompt, temperature, variation=0, stage="llm"):
+        # まとめて送った応答を、単独プロンプト（stage の段）のキャッシュとしても参照・保存できるようにする
+        cache_key = self._cache_key(prompt, temperature, variation, stage)
+        if cache_key is None:
+            return None
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            self.metrics.incr("cache_hits")
+        return cached
+
+    def remember(self, prompt, temperature, content, variation=0, stage="llm"):
+        cache_key = self._cache_key(prompt, temperature, variation, stage)
+        if cache_key is not None:
+            self.cache.put(cache_key, content)
+
+    def run(self, coro):
+        # 同期処理（ワーカースレッド）から非同期処理を実行する。
+        # HTTPクライアントの接続はイベントループに結びつくため、チャンクをまたいで同じループを使い続ける
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    def close(self):
+        if self._loop is None or self._loop.is_closed():
+            return
+        try:
+            # 途中で打ち切った処理が残っていれば、クライアントとループを閉じる前に取り消して終わらせる
+            pending = asyncio.all_tasks(self._loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            if self._owns_client:
+                self._loop.run_until_complete(self.client.close())
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        finally:
+            self._loop.close()
+            self._loop = None
+            self._semaphore = None
+            self._inflight = {}
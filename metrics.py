@@ -0,0 +1,116 @@
+import csv
+import io
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# 1,000トークンあたりの料金（USD）
+MODEL_PRICES = {
+    "gpt-3.5-turbo": {"prompt": 0.0005, "completion": 0.0015},
+}
+HISTOGRAM_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+MAX_SAMPLES = 10000
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+# --- 処理時間・トークン使用量の計測 ---
+class Metrics:
+    def __init__(self, model="gpt-3.5-turbo"):
+        self.model = model
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._buckets = {}
+        self._totals = {}
+        self._counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=MAX_SAMPLES)).append(seconds)
+            buckets = self._buckets.setdefault(stage, [0] * (len(HISTOGRAM_BUCKETS) + 1))
+            buckets[next((i for i, upper in enumerate(HISTOGRAM_BUCKETS) if seconds <= upper), len(HISTOGRAM_BUCKETS))] += 1
+            count, total = self._totals.get(stage, (0, 0.0))
+            self._totals[stage] = (count + 1, total + seconds)
+
+    def quantile(self, stage, q):
+        # 直近のサンプルから分位点を求める（サンプル数も返す）
+        with self._lock:
+            values = sorted(self._samples.get(stage, ()))
+        return percentile(values, q), len(values)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def add_usage(self, usage):
+        if usage is None:
+            return
+        self.incr("prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+        self.incr("completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+
+    def finish(self):
+        self.finished_at = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for stage, (count, total) in self._totals.items():
+                values = sorted(self._samples[stage])
+                stages[stage] = {
+                    "count": count,
+                    "total_s": total,
+                    "mean_s": total / count,
+                    "p50_s": percentile(values, 0.50),
+                    "p95_s": percentile(values, 0.95),
+                    "p99_s": percentile(values, 0.99),
+                    "histogram": dict(zip([f"<={b}s" for b in HISTOGRAM_BUCKETS] + ["inf"], self._buckets[stage]))
+                }
+            counters = dict(self._counters)
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        prices = MODEL_PRICES.get(self.model, {"prompt": 0.0, "completion": 0.0})
+        cost = (counters.get("prompt_tokens", 0) * prices["prompt"] + counters.get("completion_tokens", 0) * prices["completion"]) / 1000
+        rows = counters.get("rows", 0)
+        return {
+            "elapsed_s": elapsed,
+            "rows_per_minute": rows / elapsed * 60 if elapsed > 0 else 0.0,
+            "estimated_cost_usd": cost,
+            "cost_per_row_usd": cost / rows if rows else 0.0,
+            "counters": counters,
+            "stages": stages
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+
+    def to_csv(self):
+        snapshot = self.snapshot()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["stage", "count", "total_s", "mean_s", "p50_s", "p95_s", "p99_s"])
+        for stage, values in sorted(snapshot["stages"].items()):
+            writer.writerow([stage] + [round(values[k], 4) if isinstance(values[k], float) else values[k]
+                                       for k in ("count", "total_s", "mean_s", "p50_s", "p95_s", "p99_s")])
+        writer.writerow([])
+        writer.writerow(["metric", "value"])
+        for name in ("elapsed_s", "rows_per_minute", "estimated_cost_usd", "cost_per_row_usd"):
+            writer.writerow([name, round(snapshot[name], 6)])
+        for name, value in sorted(snapshot["counters"].items()):
+            writer.writerow([name, value])
+        return output.getvalue()
+
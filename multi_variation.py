@@ -0,0 +1,30 @@
+import json
+
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+# --- 複数バリエーションを1回の呼び出しで生成する ---
+def parse_json_items(content, count):
+    # {"items": [...]} 形式の応答から、位置ごとに妥当な項目だけを取り出す
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return {}
+    items = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return {}
+    valid = {}
+    for index, item in enumerate(items[:count]):
+        if isinstance(item, dict):
+            item = item.get("text")
+        if isinstance(item, str) and item.strip() and not item.startswith("[ERROR]"):
+            valid[index] = item.strip()
+    return valid
+
+
+async def complete_variations(engine, prompt, count):
+    # 失敗・欠落した項目は呼び出し側で1件ずつ生成し直す
+    try:
+        content = await engine.complete(prompt, temperature=0.7, response_format=JSON_RESPONSE_FORMAT, stage="detail_multi", varied=True)
+    except Exception:
+        return {}
+    return parse_json_items(content, count)
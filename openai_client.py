@@ -0,0 +1,95 @@
+import threading
+from settings import get_settings
+
+# --- OpenAIクライアントの共通設定（接続プール・段ごとのタイムアウト） ---
+# 同時実行数より多めに接続を持ち、チャンクをまたいでも接続を張り直さないように保持しておく
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 32
+DEFAULT_KEEPALIVE_EXPIRY = 60
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 60
+# 1回の呼び出しを待つ上限（秒）。短い職種名は早めに打ち切って再試行する
+STAGE_TIMEOUTS = {
+    "title": 20,
+    "title_fix": 20,
+    "title_retry": 20,
+    "copy_retry": 20,
+    "analyze": 30,
+    "describe": 30,
+    "rewrite_ad": 45,
+    "detail": 45,
+    "analyze_packed": 120,
+    "detail_multi": 120,
+    "batch": 600,
+}
+# ヘッジ（遅い呼び出しに同じ依頼をもう1本送る）の対象にできる短い段
+HEDGE_STAGES = ("title", "title_fix")
+DEFAULT_HEDGE_BUDGET = 0.05
+
+def _httpx():
+    # openai SDK のバージョンによって、使っているHTTPライブラリが httpx / httpx2 に分かれている
+    try:
+        import httpx2 as httpx
+    except ImportError:
+        import httpx
+    return httpx
+
+
+def http_settings():
+    settings = get_settings("http")
+    return {
+        "max_connections": settings.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+        "max_keepalive_connections": settings.get("max_keepalive_connections", DEFAULT_MAX_KEEPALIVE_CONNECTIONS),
+        "keepalive_expiry": settings.get("keepalive_expiry", DEFAULT_KEEPALIVE_EXPIRY),
+        "connect_timeout": settings.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+        "hedge_stages": tuple(settings.get("hedge_stages", ())),
+        "hedge_budget": settings.get("hedge_budget", DEFAULT_HEDGE_BUDGET),
+    }
+
+
+def stage_timeout(stage):
+    # secrets.toml の [timeouts] で段ごとに変更できる（例: title = 10）
+    seconds = get_settings("timeouts").get(stage, STAGE_TIMEOUTS.get(stage, DEFAULT_TIMEOUT))
+    return _httpx().Timeout(seconds, connect=http_settings()["connect_timeout"])
+
+
+def _client_options(async_client):
+    import openai
+    httpx = _httpx()
+    settings = get_settings("openai")
+    pool = http_settings()
+    limits = httpx.Limits(
+        max_connections=pool["max_connections"],
+        max_keepalive_connections=pool["max_keepalive_connections"],
+        keepalive_expiry=pool["keepalive_expiry"]
+    )
+    timeout = httpx.Timeout(DEFAULT_TIMEOUT, connect=pool["connect_timeout"])
+    http_client_class = openai.DefaultAsyncHttpxClient if async_client else openai.DefaultHttpxClient
+    # 再試行はレートリミッター側で行うため、SDKの自動リトライは無効にする。
+    # base_url を指定すると互換APIやローカルのモックサーバーに送れる
+    return {
+        "api_key": settings.get("api_key"),
+        "base_url": settings.get("base_url"),
+        "max_retries": 0,
+        "timeout": timeout,
+        "http_client": http_client_class(limits=limits, timeout=timeout),
+    }
+
+
+def make_async_client():
+    # 非同期クライアントの接続はイベントループに結びつくため、ループ（LLMEngine）ごとに1つ作る
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(**_client_options(async_client=True))
+
+
+_shared_client = None
+_shared_lock = threading.Lock()
+
+def get_shared_client():
+    # 同期クライアント（バッチAPI用）はスレッドをまたいで使えるので、全ジョブで共有する
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            from openai import OpenAI
+            _shared_client = OpenAI(**_client_options(async_client=False))
+        return _shared_client
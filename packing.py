@@ -0,0 +1,79 @@
+import asyncio
+
+DEFAULT_TOKEN_BUDGET = 3000
+DEFAULT_MAX_ITEMS = 20
+DEFAULT_FLUSH_DELAY = 0.05
+
+# --- 複数行を1つのプロンプトにまとめて送る（クロス行パッキング） ---
+# 各行の呼び出しを短時間だけ溜め、トークン予算か件数の上限に達した時点でまとめて1回のリクエストにする
+class RequestPacker:
+    def __init__(self, run_packed, run_single, estimate_tokens, base_tokens=0,
+                 token_budget=DEFAULT_TOKEN_BUDGET, max_items=DEFAULT_MAX_ITEMS, flush_delay=DEFAULT_FLUSH_DELAY):
+        # run_packed(items) は {位置: 結果} を返し、欠けた項目は run_single(item) で個別にやり直す
+        self.run_packed = run_packed
+        self.run_single = run_single
+        self.estimate_tokens = estimate_tokens
+        self.base_tokens = base_tokens
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self.flush_delay = flush_delay
+        self.packed_requests = 0
+        self.packed_items = 0
+        self.retried_items = 0
+        self._pending = []
+        self._pending_tokens = base_tokens
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        tokens = self.estimate_tokens(item)
+        # 追加すると予算を超える場合は、先に溜まっている分を送ってから積む（Kは予算に合わせて変わる）
+        if self._pending and self._pending_tokens + tokens > self.token_budget:
+            self._flush()
+        self._pending.append((item, future))
+        self._pending_tokens += tokens
+        if len(self._pending) >= self.max_items or self._pending_tokens >= self.token_budget:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        group = self._pending
+        self._pending = []
+        self._pending_tokens = self.base_tokens
+        if group:
+            asyncio.ensure_future(self._run_group(group))
+
+    async def _run_group(self, group):
+        items = [item for item, _ in group]
+        results = {}
+        if len(items) > 1:
+            self.packed_requests += 1
+            self.packed_items += len(items)
+            try:
+                results = await self.run_packed(items)
+            except Exception:
+                results = {}
+
+        async def resolve(index, item, future):
+            try:
+                if index in results:
+                    value = results[index]
+                else:
+                    # まとめた応答に含まれなかった項目だけを単独で再試行する
+                    if len(items) > 1:
+                        self.retried_items += 1
+                    value = await self.run_single(item)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            if not future.done():
+                future.set_result(value)
+
+        await asyncio.gather(*(resolve(i, item, future) for i, (item, future) in enumerate(group)))
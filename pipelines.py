@@ -0,0 +1,88 @@
+import importlib
+import os
+from io import BytesIO
+from llm_engine import DEFAULT_CONCURRENCY
+
+# --- 各モードのパイプライン（Streamlitの画面なしで呼び出すための入口） ---
+# モード名: (モジュール, 関数, バリエーション数を受け取るか, 受け付けるオプション)
+MODES = {
+    "split": ("split_module", "split_pipeline", False, ("packed",)),
+    "rewrite": ("rewrite_with_detail", "rewrite_pipeline", True, ("multi", "share_variations", "regenerate_similar")),
+    "rewrite_pr": ("rewrite_with_pr", "rewrite_pr_pipeline", True, ("multi", "share_variations", "regenerate_similar")),
+    "combined": ("rewrite_module", "rewrite_combined_pipeline", True, ("share_variations", "regenerate_similar")),
+}
+# 実行前の見積もりを行う関数（MODES と同じモジュールにある）と、見積もりに影響するオプション。
+# 似すぎた複製の作り直し（regenerate_similar）は件数を事前に予測できないため、見積もりには含めない
+ESTIMATORS = {
+    "split": ("estimate_split", ("packed",)),
+    "rewrite": ("estimate_rewrite", ("multi", "share_variations")),
+    "rewrite_pr": ("estimate_rewrite_pr", ("multi", "share_variations")),
+    "combined": ("estimate_combined", ("share_variations",)),
+}
+
+
+def frame_to_xlsx(frame):
+    # 先頭2列（職種名・仕事内容）だけをExcel形式に書き出す
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([str(name) for name in frame.columns[:2]])
+    for row in frame.iloc[:, :2].itertuples(index=False):
+        sheet.append(list(row))
+    output = BytesIO()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def open_source(source):
+    # パス・バイト列・ファイルオブジェクト・DataFrame のどれでも受け付ける
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            return BytesIO(f.read())
+    if isinstance(source, (bytes, bytearray)):
+        return BytesIO(source)
+    if hasattr(source, "iloc"):
+        return frame_to_xlsx(source)
+    return source
+
+
+def read_frame(source):
+    # 見積もり用に、使用する2列だけを DataFrame として読み込む
+    import pandas as pd
+    from excel_io import ExcelChunkReader
+    reader = ExcelChunkReader(open_source(source))
+    return pd.DataFrame(list(reader.iter_rows()), columns=reader.columns)
+
+
+def check_options(mode, options):
+    if mode not in MODES:
+        raise ValueError(f"不明なモードです: {mode}（{', '.join(MODES)} のいずれかを指定してください）")
+    allowed = MODES[mode][3]
+    unknown = set(options) - set(allowed)
+    if unknown:
+        raise ValueError(f"{mode} では使えないオプションです: {', '.join(sorted(unknown))}")
+
+
+def run_pipeline(mode, source, num_variations=3, concurrency=DEFAULT_CONCURRENCY, journal=None, job_id=None,
+                 on_progress=None, metrics=None, **options):
+    # 結果は ExcelResult（preview, data, row_count, error_count）で返す。
+    # on_progress(done, total, rows) を渡すと、1行終わるごとにその行の出力を受け取れる
+    check_options(mode, options)
+    module_name, function_name, takes_variations, _ = MODES[mode]
+    pipeline = getattr(importlib.import_module(module_name), function_name)
+    args = [open_source(source)] + ([num_variations] if takes_variations else [])
+    return pipeline(*args, concurrency=concurrency, journal=journal, job_id=job_id,
+                    on_progress=on_progress, metrics=metrics, **options)
+
+
+def estimate_pipeline(mode, frame, num_variations=3, concurrency=None, **options):
+    # 実行前に呼び出し回数・トークン数・料金・所要時間を見積もる（prompts.PromptEstimate を返す）。
+    # frame は先頭2列が職種名・仕事内容の DataFrame
+    check_options(mode, options)
+    module_name, _, takes_variations, _ = MODES[mode]
+    function_name, used = ESTIMATORS[mode]
+    estimator = getattr(importlib.import_module(module_name), function_name)
+    args = [frame] + ([num_variations] if takes_variations else [])
+    options = {name: value for name, value in options.items() if name in used}
+    return estimator(*args, concurrency=concurrency or DEFAULT_CONCURRENCY, **options)
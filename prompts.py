@@ -0,0 +1,303 @@
+import re
+import string
+from llm_engine import MODEL
+from metrics import MODEL_PRICES
+from rate_limiter import DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from settings import get_settings
+
+DEFAULT_DETAIL_TOKEN_BUDGET = 1500
+TRIM_MARK = "…"
+# 見積もり用: 1回の呼び出しにかかる時間 ≒ 固定の待ち時間 + 出力トークン数 × 生成速度
+BASE_LATENCY_SECONDS = 0.5
+SECONDS_PER_OUTPUT_TOKEN = 0.02
+
+_ASCII_PATTERN = r"[\x00-\x7f]"
+_ASCII = re.compile(_ASCII_PATTERN)
+
+# --- トークン数の見積もり（APIを呼ばずに手元で数える） ---
+# 日本語はおよそ1文字1トークン、英数字・記号はおよそ4文字で1トークンとして数える
+def count_tokens(text):
+    ascii_chars = len(_ASCII.findall(text))
+    return (4 * len(text) - 3 * ascii_chars + 3) // 4
+
+
+def count_tokens_series(series):
+    # DataFrame の列をまとめて数える（count_tokens と同じ式を列単位で計算する）
+    text = series.astype(str)
+    return (4 * text.str.len() - 3 * text.str.count(_ASCII_PATTERN) + 3) // 4
+
+
+_detail_token_budget = None
+
+def detail_token_budget():
+    # 全ての行のプロンプト生成で参照するため、設定は最初の1回だけ読む
+    global _detail_token_budget
+    if _detail_token_budget is None:
+        _detail_token_budget = get_settings("prompts").get("detail_token_budget", DEFAULT_DETAIL_TOKEN_BUDGET)
+    return _detail_token_budget
+
+
+def trim_to_budget(text, budget):
+    # 1文字は1トークン以下として数えるので、文字数が予算以内なら数えずにそのまま返す
+    if len(text) <= budget or count_tokens(text) <= budget:
+        return text
+    tokens = 0.0
+    end = len(text)
+    for i, char in enumerate(text):
+        tokens += 0.25 if char < "\x80" else 1
+        if tokens > budget - 1:
+            end = i
+            break
+    kept = text[:end]
+    # 文の途中で切らないよう、後ろ2割に句点があればそこまでにする
+    cut = kept.rfind("。", int(len(kept) * 0.8))
+    if cut != -1:
+        kept = kept[:cut + 1]
+    return kept + TRIM_MARK
+
+
+# --- プロンプトテンプレート ---
+# 指示文・例文などの固定部分（prefix）を必ず先頭に置き、行ごとに変わる値は末尾（body）にだけ差し込む。
+# 先頭がそろうので、API側のプロンプトキャッシュが効き、トークン数も行の値から見積もれる
+class PromptTemplate:
+    def __init__(self, name, prefix, body, output_tokens, trim=()):
+        self.name = name
+        self.prefix = prefix
+        self.body = body
+        # 見積もり用の、1回の呼び出しで生成されるおおよそのトークン数
+        self.output_tokens = output_tokens
+        # 長すぎる場合に detail_token_budget まで切り詰める値
+        self.trim = tuple(trim)
+        self.fields = [field for _, field, _, _ in string.Formatter().parse(body) if field]
+        self.static_tokens = count_tokens(prefix + body.format(**{field: "" for field in self.fields}))
+
+    def render(self, **values):
+        if self.trim:
+            budget = detail_token_budget()
+            for field in self.trim:
+                values[field] = trim_to_budget(str(values[field]), budget)
+        return self.prefix + self.body.format(**values)
+
+
+TEMPLATES = {}
+
+def register(name, prefix, body, output_tokens, trim=()):
+    TEMPLATES[name] = PromptTemplate(name, prefix, body, output_tokens, trim)
+    return TEMPLATES[name]
+
+
+def render(name, **values):
+    return TEMPLATES[name].render(**values)
+
+
+# --- 業務分割 ---
+register("split.analyze", """
+以下は求人広告の情報です。
+この仕事に含まれる具体的な作業内容を、箇条書きでリストアップしてください。
+箇条書きの各項目は、日本語で20文字以内に簡潔にまとめてください。
+作業名だけを出力してください（前置きや補足は不要です）。
+""", """---
+職種: {title}
+仕事内容: {detail}
+""", output_tokens=60, trim=("detail",))
+
+register("split.analyze_packed", """
+以下は複数の求人広告の情報です。
+各求人について、この仕事に含まれる具体的な作業内容をリストアップしてください。
+各項目は、日本語で20文字以内に簡潔にまとめてください。
+作業名だけを出力してください（前置きや補足は不要です）。
+出力は求人IDをキー、作業名の配列を値とするJSON形式のみとしてください。
+例: {"1": ["作業名", "作業名"], "2": ["作業名"]}
+""", """---
+{blocks}""", output_tokens=120)
+
+register("split.describe", """
+以下の仕事内容の説明をもとに、最後に示す作業が具体的に何を意味するのかを簡潔に説明してください。
+""", """---
+仕事内容の説明: {detail}
+作業: {task}
+---
+作業の説明:
+""", output_tokens=100, trim=("detail",))
+
+register("split.rewrite_ad", """
+以下の説明文を、求人広告で使用する自然な仕事の説明文に書き換えてください。
+以下のような文章のスタイルを参考にしてください。
+
+【例文1】
+製造装置への部材セットをお任せします。カメラの製造工程において、製造装置に必要な部材をセットする作業で、大小様々な材料を装置にセットして、製品の製造をスムーズに進める役割のお仕事です。
+
+【例文2】
+完成品の検査業務をお任せします。製造された製品にキズや不備がないかを確認するお仕事で、目視や道具を使って丁寧にチェックする作業です。
+
+【例文3】
+部品の梱包作業をお任せします。指定された部品をまとめ、箱に詰めてラベルを貼る作業で、出荷準備を整える大切なお仕事です。
+
+""", """---
+元の説明: {explanation}
+---
+仕事の説明文（求人広告向け）:
+""", output_tokens=120)
+
+# --- 言い換え複製（職種と仕事内容・キャッチコピー共通の職種名） ---
+register("rewrite.title", """
+以下の職種名をもとに、求人広告で使える自然な職種名のバリエーションを、各30文字以下で、指定された個数だけ作成してください。
+単語を言い換えたり、記号を変更したり、語順を変更したり、表現を言い換えて、重複しないようにしてください。
+箇条書きで出力してください。
+
+【禁止表現】
+・「募集」「募集中」「採用」といった職種名ではない表現
+・「です」「ます」といった、名称ではなく文章とみなされる表現
+""", """---
+職種名: {title}
+作成する個数: {num_variations}個
+---
+""", output_tokens=25)
+
+register("rewrite.detail", """
+以下の職種名と仕事内容をもとに、単語を言い換えたり、記号や語順を変更したりして、全く異なる自然な表現の案内文を作成してください。
+""", """---
+職種名: {title}
+仕事内容: {detail}
+---
+案内文:
+""", output_tokens=250, trim=("detail",))
+
+register("rewrite.detail_multi", """
+以下の職種名と仕事内容をもとに、各職種名に対応する案内文を1つずつ、職種名と同じ個数だけ作成してください。
+単語を言い換えたり、記号や語順を変更したりして、全く異なる自然な表現にしてください。案内文同士も互いに異なる表現にしてください。
+出力は {"items": ["1つ目の職種名の案内文", "2つ目の職種名の案内文", ...]} というJSON形式のみとしてください。
+""", """---
+職種名:
+{titles}
+仕事内容: {detail}
+作成する個数: {count}個
+---
+""", output_tokens=250, trim=("detail",))
+
+register("rewrite_pr.detail", """
+以下の求人広告のキャッチコピーをもとに、単語を言い換えたり、記号や語順を変更したりして、全く異なる自然な表現の新しいキャッチコピーを30文字以内で作成してください。
+""", """---
+キャッチコピー: {detail}
+---
+新しいキャッチコピー:
+""", output_tokens=30, trim=("detail",))
+
+register("rewrite_pr.detail_multi", """
+以下の求人広告のキャッチコピーをもとに、単語を言い換えたり、記号や語順を変更したりして、全く異なる自然な表現の新しいキャッチコピーを30文字以内で、指定された個数だけ作成してください。
+キャッチコピー同士も互いに異なる表現にしてください。
+出力は {"items": ["1つ目のキャッチコピー", "2つ目のキャッチコピー", ...]} というJSON形式のみとしてください。
+""", """---
+キャッチコピー: {detail}
+作成する個数: {count}個
+---
+""", output_tokens=30, trim=("detail",))
+
+# 似すぎた複製を作り直すとき（3つの言い換えモード共通）
+register("variation.title_retry", """
+以下の職種名をもとに、求人広告で使える自然な職種名を1つだけ、30文字以下で作成してください。
+元の職種名や既出の案とは、単語・記号・語順・表現を変えて、はっきり異なるものにしてください。
+職種名だけを出力してください（前置きや補足は不要です）。
+
+【禁止表現】
+・「募集」「募集中」「採用」といった職種名ではない表現
+・「です」「ます」といった、名称ではなく文章とみなされる表現
+""", """---
+職種名: {title}
+既出の案:
+{existing}
+---
+""", output_tokens=20)
+
+# キャッチコピーの作り直し（キャッチコピーバージョン）
+register("variation.copy_retry", """
+以下の求人広告のキャッチコピーをもとに、新しいキャッチコピーを1つだけ、30文字以内で作成してください。
+元のキャッチコピーや既出の案とは、単語・記号・語順・表現を変えて、はっきり異なるものにしてください。
+キャッチコピーだけを出力してください（前置きや補足は不要です）。
+""", """---
+キャッチコピー: {detail}
+既出の案:
+{existing}
+---
+""", output_tokens=30, trim=("detail",))
+
+# --- 言い換え複製（一括リライト） ---
+register("combined.title", """
+以下の職種名を、求人広告で使える自然な職種名に整えてください。
+出力は25文字以内で、「です」「ます」や句読点を付けずに簡潔な名詞として作成してください。
+""", """---
+元の職種名（案）: {title}
+---
+整形後:
+""", output_tokens=20)
+
+register("combined.title_fix", """
+以下の表現は職種名として不適切です。求人広告で使える自然な職種名に修正してください。
+""", """---
+修正前: {title}
+---
+職種名:
+""", output_tokens=20)
+
+register("combined.detail", """
+以下の職種名と仕事内容をもとに、単語を言い換えたり、記号を変更したり、語順を変更したりして、全く異なる表現にリライトしてください。
+出力は、求人広告で使用する自然な文章で作成してください。
+""", """---
+職種名: {title}
+仕事内容: {detail}
+---
+案内文:
+""", output_tokens=250, trim=("detail",))
+
+
+# --- 実行前の見積もり（呼び出し回数・トークン数・料金・所要時間） ---
+def field_tokens(series, trim=False):
+    tokens = count_tokens_series(series)
+    return tokens.clip(upper=detail_token_budget()) if trim else tokens
+
+
+class PromptEstimate:
+    def __init__(self, rows, concurrency, model=MODEL):
+        self.rows = rows
+        self.concurrency = concurrency
+        self.model = model
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.call_seconds = 0.0
+
+    def add(self, name, calls, variable_tokens=0, output_tokens=None):
+        # variable_tokens は calls 回分の差し込み値のトークン数の合計
+        template = TEMPLATES[name]
+        output_tokens = template.output_tokens if output_tokens is None else output_tokens
+        calls = int(calls)
+        self.calls += calls
+        self.prompt_tokens += calls * template.static_tokens + int(variable_tokens)
+        self.completion_tokens += calls * output_tokens
+        self.call_seconds += calls * (BASE_LATENCY_SECONDS + output_tokens * SECONDS_PER_OUTPUT_TOKEN)
+
+    def cost_usd(self):
+        prices = MODEL_PRICES.get(self.model, {"prompt": 0.0, "completion": 0.0})
+        return (self.prompt_tokens * prices["prompt"] + self.completion_tokens * prices["completion"]) / 1000
+
+    def runtime_seconds(self):
+        # 同時実行数・RPM・TPM のうち、最も厳しい制約で決まる
+        settings = get_settings("openai")
+        rpm = settings.get("requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE)
+        tpm = settings.get("tokens_per_minute", DEFAULT_TOKENS_PER_MINUTE)
+        return max(
+            self.call_seconds / max(self.concurrency, 1),
+            self.calls / rpm * 60,
+            (self.prompt_tokens + self.completion_tokens) / tpm * 60
+        )
+
+    def as_dict(self):
+        return {
+            "rows": self.rows,
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "estimated_cost_usd": self.cost_usd(),
+            "estimated_seconds": self.runtime_seconds(),
+        }
+
@@ -0,0 +1,186 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from settings import get_settings
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+COMPLETION_TOKEN_RESERVE = 256
+
+# --- トークンバケット ---
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        rate = self.capacity / 60.0
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * rate)
+        self.updated_at = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        # 1回の要求が容量を超える場合は満タンになるまで待って通す
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / (self.capacity / 60.0)
+
+    def consume(self, amount):
+        self.level -= amount
+
+
+# --- レート制限ヘッダーの解析 ---
+def parse_reset_duration(value):
+    # "1s", "6m0s", "20ms", "1h2m3.5s" のような形式を秒に変換する
+    if value is None:
+        return None
+    total = 0.0
+    matched = False
+    for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", str(value)):
+        matched = True
+        number = float(number)
+        total += {"ms": number / 1000, "s": number, "m": number * 60, "h": number * 3600}[unit]
+    if not matched:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return total
+
+
+def retry_after_seconds(headers):
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return None
+    return None
+
+
+def error_status(error):
+    status = getattr(error, "status_code", None)
+    if status is None and getattr(error, "response", None) is not None:
+        status = getattr(error.response, "status_code", None)
+    return status
+
+
+def is_quota_error(error):
+    # 利用上限（insufficient_quota）は待っても回復しないため再試行しない
+    return getattr(error, "code", None) == "insufficient_quota" or "insufficient_quota" in str(error)
+
+
+def is_retryable(error):
+    if is_quota_error(error):
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    # 接続エラー・タイムアウトはステータスを持たない
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+# --- RPM/TPM を同時に管理するクライアント側レートリミッター ---
+class RateLimiter:
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                 max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def estimate_tokens(self, prompt):
+        # 日本語はおおよそ1文字1トークン以上になるため、文字数を控えめな見積もりとして使う
+        return len(prompt) + COMPLETION_TOKEN_RESERVE
+
+    def _reserve(self, estimated_tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self.blocked_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(estimated_tokens, now)
+            )
+            if wait <= 0:
+                self.requests.consume(1)
+                self.tokens.consume(estimated_tokens)
+            return wait
+
+    async def acquire(self, estimated_tokens):
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        # 見積もりと実際の使用量の差を精算する
+        if actual_tokens is None:
+            return
+        with self._lock:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+
+    def update_from_headers(self, headers):
+        if headers is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                try:
+                    if limit is not None:
+                        bucket._refill(now)
+                        bucket.capacity = float(limit)
+                    if remaining is not None:
+                        bucket._refill(now)
+                        bucket.level = min(bucket.level, float(remaining))
+                except ValueError:
+                    continue
+                if remaining is not None and remaining.strip() == "0":
+                    reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                    if reset:
+                        self.blocked_until = max(self.blocked_until, now + reset)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            # サーバー指定の待ち時間に少しだけゆらぎを足して同時再開を避ける
+            return retry_after + random.uniform(0, self.base_delay)
+        # 指数バックオフ（フルジッター）
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def block_for(self, seconds):
+        # 429を受けたら全リクエストをまとめて待たせる
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+_shared_limiter = None
+_shared_lock = threading.Lock()
+
+def get_shared_limiter():
+    # レート制限はアカウント単位なので、全モード・全セッションで1つのリミッターを共有する
+    global _shared_limiter
+    with _shared_lock:
+        if _shared_limiter is None:
+            settings = get_settings("openai")
+            _shared_limiter = RateLimiter(
+                requests_per_minute=settings.get("requests_per_minute", DEFAULT_REQUESTS_PER_MINUTE),
+                tokens_per_minute=settings.get("tokens_per_minute", DEFAULT_TOKENS_PER_MINUTE)
+            )
+        return _shared_limiter
@@ -0,0 +1,88 @@
+import json
+import os
+import random
+import threading
+
+REPLACEMENT_DICT_PATH = "replacement_dict.json"
+_END = object()
+
+# --- 置換辞書のマッチャー（辞書を一度だけトライ木に変換しておく） ---
+# キーは文字単位のトライに登録し、形態素の区切りで始まり区切りで終わる最長一致だけを置換する。
+# 「ホールスタッフ」のように MeCab が複数の形態素に分ける複合語のキーもこれで一致する。
+class ReplacementMatcher:
+    def __init__(self, entries):
+        self.size = 0
+        self._root = {}
+        for key, alternatives in entries.items():
+            alternatives = [a for a in alternatives if isinstance(a, str)] if isinstance(alternatives, list) else []
+            if not key or not alternatives:
+                continue
+            node = self._root
+            for char in key:
+                node = node.setdefault(char, {})
+            node[_END] = alternatives
+            self.size += 1
+
+    def find_spans(self, surfaces):
+        # (開始の形態素位置, 終了の形態素位置, 置換候補) のリストを返す
+        text = "".join(surfaces)
+        offsets = [0]
+        for surface in surfaces:
+            offsets.append(offsets[-1] + len(surface))
+        boundary = {offset: i for i, offset in enumerate(offsets)}
+
+        spans = []
+        i = 0
+        while i < len(surfaces):
+            node = self._root
+            pos = offsets[i]
+            best = None
+            while pos < len(text) and text[pos] in node:
+                node = node[text[pos]]
+                pos += 1
+                if _END in node and pos in boundary:
+                    best = (boundary[pos], node[_END])
+            if best is None:
+                i += 1
+                continue
+            spans.append((i, best[0], best[1]))
+            i = best[0]
+        return spans
+
+    def variations(self, surfaces, count, rng=random):
+        # 一致箇所ごとに全コピー分の候補をまとめて抽選し、コピーごとに組み立てる
+        spans = self.find_spans(surfaces)
+        picks = [rng.choices(alternatives, k=count) for _, _, alternatives in spans]
+        results = []
+        for copy_index in range(count):
+            parts = []
+            pos = 0
+            for (start, end, _), choices in zip(spans, picks):
+                parts.extend(surfaces[pos:start])
+                parts.append(choices[copy_index])
+                pos = end
+            parts.extend(surfaces[pos:])
+            results.append("".join(parts))
+        return results
+
+
+_shared_matcher = None
+_shared_mtime = None
+_shared_lock = threading.Lock()
+
+def get_replacement_matcher(path=REPLACEMENT_DICT_PATH):
+    # 辞書ファイルの更新時刻が変わったときだけ読み込み直す
+    global _shared_matcher, _shared_mtime
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    with _shared_lock:
+        if _shared_matcher is None or mtime != _shared_mtime:
+            entries = {}
+            if mtime is not None:
+                with open(path, "r", encoding="utf-8") as f:
+                    entries = json.load(f)
+            _shared_matcher = ReplacementMatcher(entries)
+            _shared_mtime = mtime
+        return _shared_matcher
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from settings import get_settings
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "llm_responses.sqlite3")
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+DEFAULT_MAX_AGE_DAYS = 30
+EVICT_EVERY = 200
+# キャッシュするのは結果がほぼ決まっている段だけにする。
+# バリエーションを作る段までキャッシュすると、同じファイルを再実行しても毎回同じ複製しか出なくなる
+DEFAULT_CACHED_STAGES = ("analyze", "analyze_packed", "describe")
+
+# --- LLM応答の永続キャッシュ（内容アドレス方式） ---
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model, prompt, temperature, variation=0):
+        payload = json.dumps([model, prompt, temperature, variation], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now)
+            )
+            self._conn.commit()
+            self._puts += 1
+            should_evict = self._puts % EVICT_EVERY == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        # 期限切れを削除したあと、容量上限を超えていれば最終利用が古い順に削除する
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                stale_keys = []
+                for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                    if freed >= excess:
+                        break
+                    stale_keys.append((key,))
+                    freed += size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def get_shared_cache():
+    # キャッシュファイルは全モード・全セッションで共有する
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            settings = get_settings("cache")
+            _shared_cache = ResponseCache(
+                path=settings.get("path", DEFAULT_CACHE_PATH),
+                max_bytes=settings.get("max_mb", DEFAULT_MAX_BYTES // (1024 * 1024)) * 1024 * 1024,
+                max_age_days=settings.get("max_age_days", DEFAULT_MAX_AGE_DAYS)
+            )
+        return _shared_cache
+
+
+def cached_stages():
+    # secrets.toml の [cache] stages で変更できる（例: stages = ["analyze", "describe", "rewrite_ad"]）
+    return tuple(get_settings("cache").get("stages", DEFAULT_CACHED_STAGES))
+
+
+def render_cache_stats(container):
+    stats = get_shared_cache().stats()
+    total = stats["hits"] + stats["misses"]
+    hit_rate = stats["hits"] / total * 100 if total else 0.0
+    container.caption(
+        f"💾 キャッシュ: ヒット {stats['hits']} / ミス {stats['misses']}（{hit_rate:.0f}%）"
+        f"・{stats['entries']}件 {stats['bytes'] / (1024 * 1024):.1f}MB"
+    )
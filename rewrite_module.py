@@ -1,35 +1,104 @@
 import streamlit as st
-import pandas as pd
-from openai import OpenAI
 from io import BytesIO
-import fugashi
-import random
-import json
+import asyncio
 import os
-
-# OpenAI APIキーの設定
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-
-tagger = fugashi.Tagger()
-
-# --- 共通関数 ---
-def convert_df(df):
-    from io import BytesIO
-    output = BytesIO()
-    df.to_excel(output, index=False, engine="openpyxl")
-    return output.getvalue()
-
-# --- 辞書読み込み ---
-def load_replacement_dict():
-    path = "replacement_dict.json"
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    else:
-        st.warning("⚠ 置換辞書（replacement_dict.json）が見つかりません。")
-        return {}
-
-replacement_dict = load_replacement_dict()
+from llm_engine import LLMEngine, DEFAULT_CONCURRENCY
+from excel_io import ExcelChunkReader, StreamingExcelWriter
+from job_journal import run_chunk
+from job_runner import JobAlreadyRunning, ProgressCounter, StartButton, get_shared_runner, prepare_job, render_estimate, render_job_status, render_result_downloads, show_error_rows, show_resume_info
+from prompts import PromptEstimate, field_tokens, render
+from similarity import SCORE_COLUMN, refine_variations
+from replacement_matcher import REPLACEMENT_DICT_PATH, get_replacement_matcher
+from tokenizer import get_shared_tokenizer
+
+# --- 1行分の処理 ---
+async def process_row(engine, title, detail, num_copies, matcher):
+    # 形態素解析は1行につき1回だけ行い、全コピーの置換案をまとめて作る
+    with engine.metrics.timer("tokenize"):
+        word_surfaces = get_shared_tokenizer().surfaces(title)
+    raw_variations = matcher.variations(word_surfaces, num_copies)
+
+    async def rewrite_copy(copy_index):
+        raw_variation = raw_variations[copy_index]
+
+        # AIで整形
+        try:
+            prompt = render("combined.title", title=raw_variation)
+            new_title = (await engine.complete(prompt, temperature=0.5, variation=copy_index, stage="title", varied=True)).strip()
+
+            # 🔽 追加処理：整形後の職種名をクリーンアップ
+            new_title = new_title.splitlines()[0]  # 複数行のうち最初の行のみ
+            new_title = new_title.split("バリエーション")[0].strip()  # 「バリエーション」以降を削除
+
+            # 職種名でない表現を検出し再修正
+            if any(x in new_title for x in ["する", "です", "募集"]):
+                reprompt = render("combined.title_fix", title=new_title)
+                retry = await engine.complete(reprompt, temperature=0.3, variation=copy_index, stage="title_fix", varied=True)
+                new_title = retry.strip().splitlines()[0]
+
+        except Exception as e:
+            new_title = f"[ERROR] {e}"
+
+        # 案内文生成
+        try:
+            prompt = render("combined.detail", title=title, detail=detail)
+            new_detail = (await engine.complete(prompt, temperature=0.7, variation=copy_index, stage="detail", varied=True)).strip()
+        except Exception as e:
+            new_detail = f"[ERROR] {e}"
+
+        return {
+            "元の職種名": title,
+            "元の仕事内容": detail,
+            "複製の職種名": new_title,
+            "複製の仕事内容": new_detail
+        }
+
+    return await asyncio.gather(*(rewrite_copy(copy_index) for copy_index in range(num_copies)))
+
+# --- 実行前の見積もり ---
+def estimate_combined(frame, num_copies, concurrency=DEFAULT_CONCURRENCY, share_variations=False):
+    # 職種名の案は置換辞書から作るため、整形と案内文の2回をコピーごとに呼び出す（再修正は含めない）
+    rows = frame.iloc[:, :2].drop_duplicates() if share_variations else frame.iloc[:, :2]
+    titles = field_tokens(rows.iloc[:, 0])
+    details = field_tokens(rows.iloc[:, 1], trim=True)
+    estimate = PromptEstimate(len(frame), concurrency)
+    estimate.add("combined.title", len(rows) * num_copies, titles.sum() * num_copies)
+    estimate.add("combined.detail", len(rows) * num_copies, (titles.sum() + details.sum()) * num_copies)
+    return estimate
+
+# --- パイプライン（Streamlitに依存しないのでバックグラウンドで実行できる） ---
+def rewrite_combined_pipeline(file, num_copies, concurrency=DEFAULT_CONCURRENCY, journal=None, job_id=None, on_progress=None, metrics=None,
+                              share_variations=False, regenerate_similar=True):
+    engine = LLMEngine(concurrency=concurrency, metrics=metrics, share_variations=share_variations)
+    reader = ExcelChunkReader(file, metrics=engine.metrics)
+    writer = StreamingExcelWriter(["元の職種名", "元の仕事内容", "複製の職種名", "複製の仕事内容", SCORE_COLUMN], metrics=engine.metrics)
+    counter = ProgressCounter(reader.count_rows(), on_progress, engine.metrics)
+    matcher = get_replacement_matcher()
+    tokenizer = get_shared_tokenizer()
+
+    async def run_row(title, detail):
+        return await process_row(engine, title, detail, num_copies, matcher)
+
+    async def run_rows(chunk, offset):
+        # チャンク全体の複製をまとめて比べ、似すぎた職種名だけを作り直す（案内文は元の職種名から作るのでそのまま）
+        row_groups = await run_chunk(chunk, offset, run_row, journal, job_id, counter.advance, grouped=True)
+        return await refine_variations(engine, row_groups, regenerate_similar)
+
+    # チャンク単位で処理して書き出すため、入力サイズに関係なくメモリ使用量は一定になる
+    offset = 0
+    try:
+        for chunk in reader.iter_chunks():
+            # 職種名はチャンク単位でまとめて解析しておき、行ごとの処理ではキャッシュから取り出す
+            with engine.metrics.timer("tokenize_batch"):
+                tokenizer.tokenize_many([title for title, _ in chunk])
+            writer.append_rows(engine.run(run_rows(chunk, offset)))
+            offset += len(chunk)
+    finally:
+        engine.close()
+
+    if journal is not None:
+        journal.finish(job_id)
+    return writer.close()
 
 # --- 言い換え複製（職種名と仕事内容を一括処理） ---
 def run_rewrite_combined():
@@ -37,118 +106,53 @@ def run_rewrite_combined():
 
     if "rewrite_combined_output" not in st.session_state:
         st.session_state.rewrite_combined_output = None
+    if "rewrite_combined_job_id" not in st.session_state:
+        st.session_state.rewrite_combined_job_id = None
 
     if st.button("🔄 リセット"):
         st.session_state.rewrite_combined_output = None
 
+    if not os.path.exists(REPLACEMENT_DICT_PATH):
+        st.warning("⚠ 置換辞書（replacement_dict.json）が見つかりません。")
+
     uploaded_file = st.file_uploader("Excelファイルを選択（A列=職種名, B列=仕事内容）", type=["xlsx"], key="combined_upload")
     num_copies = st.slider("バリエーション数（1〜5）", min_value=1, max_value=5, value=3)
+    concurrency = st.slider("同時リクエスト数", min_value=1, max_value=32, value=DEFAULT_CONCURRENCY)
+    resume = st.checkbox("中断したジョブがあれば続きから再開する（同じファイル・同じ設定の場合）", value=True)
+    share_variations = st.checkbox("同じ内容の行には同じ複製を使う（API呼び出しを節約）", value=False)
+    regenerate_similar = st.checkbox("元の職種名や他の複製とほぼ同じ職種名は作り直す", value=True)
+
+    if uploaded_file:
+        render_estimate("combined", uploaded_file.getvalue(), num_copies, concurrency, share_variations=share_variations)
 
-    if st.button("処理を開始する") and uploaded_file:
-        df = pd.read_excel(uploaded_file, engine="openpyxl")
-        df.replace({r"_x000D_": "", r"\r": "", r"\n": ""}, regex=True, inplace=True)
+    start = StartButton("rewrite_combined_job_id")
+    if start.clicked and uploaded_file:
+        reader = ExcelChunkReader(uploaded_file)
 
         st.success("ファイルを読み込みました ✅")
-        st.dataframe(df.head())
-
-        results = []
-
-        with st.spinner("AIで職種名と言い換え文章を生成中..."):
-            for i in range(len(df)):
-                title = str(df.iloc[i, 0])
-                detail = str(df.iloc[i, 1])
-
-                words = list(tagger(title))
-                word_surfaces = [w.surface for w in words]
-
-                for _ in range(num_copies):
-                    replaced_words = []
-                    for word in word_surfaces:
-                        if word in replacement_dict:
-                            replaced = random.choice(replacement_dict[word])
-                            replaced_words.append(replaced)
-                        else:
-                            replaced_words.append(word)
-                    raw_variation = ''.join(replaced_words)
-
-                    # AIで整形
-                    try:
-                        prompt = f"""
-以下の職種名を、求人広告で使える自然な職種名に整えてください。
-出力は25文字以内で、「です」「ます」や句読点を付けずに簡潔な名詞として作成してください。
----
-元の職種名（案）: {raw_variation}
----
-整形後:
-"""
-                        response = client.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            temperature=0.5
-                        )
-                        new_title = response.choices[0].message.content.strip()
-
-                        # 🔽 追加処理：整形後の職種名をクリーンアップ
-                        new_title = new_title.splitlines()[0]  # 複数行のうち最初の行のみ
-                        new_title = new_title.split("バリエーション")[0].strip()  # 「バリエーション」以降を削除
-
-                        # 職種名でない表現を検出し再修正
-                        if any(x in new_title for x in ["する", "です", "募集"]):
-                            reprompt = f"""
-以下の表現は職種名として不適切です。求人広告で使える自然な職種名に修正してください。
----
-修正前: {new_title}
----
-職種名:
-"""
-                            retry = client.chat.completions.create(
-                                model="gpt-3.5-turbo",
-                                messages=[{"role": "user", "content": reprompt}],
-                                temperature=0.3
-                            )
-                            new_title = retry.choices[0].message.content.strip().splitlines()[0]
-
-                    except Exception as e:
-                        new_title = f"[ERROR] {e}"
-
-                    # 案内文生成
-                    try:
-                        prompt = f"""
-以下の職種名と仕事内容をもとに、単語を言い換えたり、記号を変更したり、語順を変更したりして、全く異なる表現にリライトしてください。
-出力は、求人広告で使用する自然な文章で作成してください。
----
-職種名: {title}
-仕事内容: {detail}
----
-案内文:
-"""
-                        response = client.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            temperature=0.7
-                        )
-                        new_detail = response.choices[0].message.content.strip()
-                    except Exception as e:
-                        new_detail = f"[ERROR] {e}"
-
-                    results.append({
-                        "元の職種名": title,
-                        "元の仕事内容": detail,
-                        "複製の職種名": new_title,
-                        "複製の仕事内容": new_detail
-                    })
-
-        df_result = pd.DataFrame(results)
-        st.session_state.rewrite_combined_output = df_result
+        st.dataframe(reader.preview())
+
+        # 処理はバックグラウンドのワーカーで実行し、画面は進捗を定期的に確認するだけにする
+        file_bytes = uploaded_file.getvalue()
+        try:
+            journal, journal_id = prepare_job("rewrite_combined", file_bytes, uploaded_file.name, {"num_copies": num_copies, "share_variations": share_variations, "regenerate_similar": regenerate_similar}, resume)
+            show_resume_info(journal, journal_id)
+            st.session_state.rewrite_combined_job_id = get_shared_runner().submit(
+                "rewrite_combined", uploaded_file.name, rewrite_combined_pipeline, BytesIO(file_bytes), num_copies,
+                concurrency=concurrency, share_variations=share_variations, regenerate_similar=regenerate_similar,
+                journal=journal, job_id=journal_id
+            )
+        except JobAlreadyRunning as e:
+            st.warning(f"⚠ {e}")
+        else:
+            st.session_state.rewrite_combined_output = None
+            start.started()
+
+    render_job_status("rewrite_combined_job_id", "rewrite_combined_output")
 
     if st.session_state.rewrite_combined_output is not None:
         st.success("✅ 言い換え複製 完了！")
-        st.dataframe(st.session_state.rewrite_combined_output.head(10))
-
-        excel_data = convert_df(st.session_state.rewrite_combined_output)
-        st.download_button(
-            label="📥 結果をダウンロード（Excel）",
-            data=excel_data,
-            file_name="ai_job_rewrite_output.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
\ No newline at end of file
+        show_error_rows(st.session_state.rewrite_combined_output)
+        st.dataframe(st.session_state.rewrite_combined_output.preview)
+
+        render_result_downloads(st.session_state.rewrite_combined_output, "ai_job_rewrite_output", "rewrite_combined")
\ No newline at end of file
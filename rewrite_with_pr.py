@@ -1,17 +1,178 @@
 import streamlit as st
-import pandas as pd
-from openai import OpenAI
 from io import BytesIO
+import asyncio
 import re
+from llm_engine import LLMEngine, DEFAULT_CONCURRENCY, iter_lines
+from batch_api import run_variation_batches
+from metrics import Metrics
+from multi_variation import complete_variations
+from excel_io import ExcelChunkReader, StreamingExcelWriter
+from job_journal import run_chunk
+from job_runner import JobAlreadyRunning, ProgressCounter, StartButton, get_shared_runner, prepare_job, render_estimate, render_job_status, render_result_downloads, show_error_rows, show_resume_info
+from openai_client import get_shared_client
+from similarity import COPY_FIELD, SCORE_COLUMN, TITLE_FIELD, combine_scores, format_score, refine_variations, score_groups
+from prompts import PromptEstimate, TEMPLATES, field_tokens, render
 
-# OpenAI APIキーを取得
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
+OUTPUT_COLUMNS = ["元の職種名", "元のキャッチコピー", "複製の職種名", "複製のキャッチコピー", SCORE_COLUMN]
 
-# --- 共通関数 ---
-def convert_df(df):
-    output = BytesIO()
-    df.to_excel(output, index=False, engine="openpyxl")
-    return output.getvalue()
+# --- プロンプト生成 ---
+def build_prompt_title(title, num_variations):
+    return render("rewrite.title", title=title, num_variations=num_variations)
+
+def build_prompt_detail(var_title, detail):
+    return render("rewrite_pr.detail", detail=detail)
+
+def build_prompt_detail_multi(var_titles, detail):
+    return render("rewrite_pr.detail_multi", detail=detail, count=len(var_titles))
+
+def parse_variation_line(line):
+    return re.sub(r"^[-\d\.・\s]+", "", line).strip()
+
+def parse_variations(content):
+    lines = content.strip().splitlines()
+    return [parse_variation_line(line) for line in lines if line.strip()]
+
+# --- 1行分の処理 ---
+async def process_row(engine, title, detail, num_variations, multi=False):
+    prompt_title = build_prompt_title(title, num_variations)
+    generated = {}
+
+    async def rewrite_variation(index, var_title):
+        # --- ステップ2: キャッチコピーを生成 ---
+        if index in generated:
+            rewritten_detail = generated[index]
+        elif var_title.startswith("[ERROR]"):
+            # 職種名の生成に失敗した行は呼び出さず、同じエラーを残して再開時にやり直す
+            rewritten_detail = var_title
+        else:
+            prompt_detail = build_prompt_detail(var_title, detail)
+            try:
+                rewritten_detail = (await engine.complete(prompt_detail, temperature=0.7, variation=index, stage="detail", varied=True)).strip()
+            except Exception as e:
+                rewritten_detail = f"[ERROR] {e}"
+
+        return {
+            "元の職種名": title,
+            "元のキャッチコピー": detail,
+            "複製の職種名": var_title,
+            "複製のキャッチコピー": rewritten_detail
+        }
+
+    # --- ステップ1: 職種名をAIでリスト出力 ---
+    if multi:
+        # まとめて生成するモードでは全バリエーションを1回で依頼し、欠落・不正な項目だけを個別に生成する
+        try:
+            content = await engine.complete(prompt_title, temperature=0.7, stage="title", varied=True)
+            variations = parse_variations(content)[:num_variations]
+        except Exception as e:
+            variations = [f"[ERROR] {e}" for _ in range(num_variations)]
+        else:
+            if variations:
+                generated = await complete_variations(engine, build_prompt_detail_multi(variations, detail), len(variations))
+        return await asyncio.gather(*(
+            rewrite_variation(index, v) for index, v in enumerate(variations)
+        ))
+
+    # 職種名はストリームで受け取り、1行そろうたびにその行のステップ2を始める（全行の到着を待たない）
+    tasks = []
+    try:
+        async for line in iter_lines(engine.stream(prompt_title, temperature=0.7, stage="title", varied=True)):
+            if line.strip() and len(tasks) < num_variations:
+                tasks.append(asyncio.ensure_future(rewrite_variation(len(tasks), parse_variation_line(line))))
+    except Exception as e:
+        # 途中で失敗した場合は、受け取れなかった分をエラー行にして再開時にやり直せるようにする
+        tasks += [asyncio.ensure_future(rewrite_variation(index, f"[ERROR] {e}")) for index in range(len(tasks), num_variations)]
+    return await asyncio.gather(*tasks)
+
+# --- 実行前の見積もり ---
+def estimate_rewrite_pr(frame, num_variations, concurrency=DEFAULT_CONCURRENCY, multi=False, share_variations=False):
+    # 同じ内容の行に同じ複製を使う場合は、重複を除いた行だけが呼び出しの対象になる
+    rows = frame.iloc[:, :2].drop_duplicates() if share_variations else frame.iloc[:, :2]
+    titles = field_tokens(rows.iloc[:, 0])
+    details = field_tokens(rows.iloc[:, 1], trim=True)
+    title_tokens = TEMPLATES["rewrite.title"].output_tokens
+    estimate = PromptEstimate(len(frame), concurrency)
+    estimate.add("rewrite.title", len(rows), titles.sum(), output_tokens=title_tokens * num_variations)
+    if multi:
+        estimate.add("rewrite_pr.detail_multi", len(rows), details.sum(),
+                     output_tokens=TEMPLATES["rewrite_pr.detail_multi"].output_tokens * num_variations)
+    else:
+        estimate.add("rewrite_pr.detail", len(rows) * num_variations, details.sum() * num_variations)
+    return estimate
+
+# --- パイプライン（Streamlitに依存しないのでバックグラウンドで実行できる） ---
+def rewrite_pr_pipeline(file, num_variations, concurrency=DEFAULT_CONCURRENCY, multi=False, journal=None, job_id=None, on_progress=None, metrics=None,
+                        share_variations=False, regenerate_similar=True):
+    engine = LLMEngine(concurrency=concurrency, metrics=metrics, share_variations=share_variations)
+    reader = ExcelChunkReader(file, metrics=engine.metrics)
+    writer = StreamingExcelWriter(OUTPUT_COLUMNS, metrics=engine.metrics)
+    counter = ProgressCounter(reader.count_rows(), on_progress, engine.metrics)
+
+    async def run_row(title, detail):
+        return await process_row(engine, title, detail, num_variations, multi)
+
+    async def run_rows(chunk, offset):
+        # チャンク全体の複製をまとめて比べ、職種名・キャッチコピーのうち似すぎたものだけを作り直す
+        # （キャッチコピーは職種名に依存しないので、それぞれ単独で作り直せる）
+        row_groups = await run_chunk(chunk, offset, run_row, journal, job_id, counter.advance, grouped=True)
+        return await refine_variations(engine, row_groups, regenerate_similar, fields=(TITLE_FIELD, COPY_FIELD))
+
+    # チャンク単位で処理して書き出すため、入力サイズに関係なくメモリ使用量は一定になる
+    offset = 0
+    try:
+        for chunk in reader.iter_chunks():
+            writer.append_rows(engine.run(run_rows(chunk, offset)))
+            offset += len(chunk)
+    finally:
+        engine.close()
+
+    if journal is not None:
+        journal.finish(job_id)
+    return writer.close()
+
+# --- バッチモード ---
+def rewrite_pr_batch_pipeline(file, num_variations, journal=None, job_id=None, on_progress=None, metrics=None, client=None):
+    # journal を渡すと送信したバッチIDを記録し、再開・再起動時は同じバッチの完了を待つ
+    client = client if client is not None else get_shared_client()
+    metrics = metrics if metrics is not None else Metrics()
+    reader = ExcelChunkReader(file, metrics=metrics)
+    writer = StreamingExcelWriter(OUTPUT_COLUMNS, metrics=metrics)
+    # バッチは全行をまとめて送るため、使用する2列の文字列だけを保持する
+    titles = []
+    details = []
+    for title, detail in reader.iter_rows():
+        titles.append(title)
+        details.append(detail)
+
+    def report_batch(completed, total):
+        # ジョブがキャンセルされるとここで例外になり、送信中のバッチも取り消される
+        if on_progress is not None:
+            on_progress(completed, total)
+
+    with metrics.timer("batch"):
+        row_results = run_variation_batches(
+            client, titles, details, num_variations,
+            build_prompt_title, build_prompt_detail, parse_variations,
+            on_poll=report_batch, journal=journal, job_id=job_id
+        )
+    metrics.incr("rows", len(titles))
+
+    # バッチの結果は後から作り直せないため、独自性スコアだけを付ける
+    with metrics.timer("similarity"):
+        title_scores, _ = score_groups([(title, [var_title for var_title, _ in variations]) for title, variations in zip(titles, row_results)])
+        copy_scores, _ = score_groups([(detail, [copy for _, copy in variations]) for detail, variations in zip(details, row_results)])
+        scores = combine_scores([title_scores, copy_scores])
+    for title, detail, variations, row_scores in zip(titles, details, row_results, scores):
+        writer.append_rows([{
+            "元の職種名": title,
+            "元のキャッチコピー": detail,
+            "複製の職種名": var_title,
+            "複製のキャッチコピー": rewritten_detail,
+            SCORE_COLUMN: format_score(score)
+        } for (var_title, rewritten_detail), score in zip(variations, row_scores)])
+    if journal is not None:
+        journal.finish(job_id)
+    return writer.close()
 
 # --- 言い換え複製 キャッチコピーバージョン ---
 def rewrite_pr():
@@ -19,84 +180,57 @@ def rewrite_pr():
 
     if "df_result_rewrite" not in st.session_state:
         st.session_state.df_result_rewrite = None
+    if "rewrite_pr_job_id" not in st.session_state:
+        st.session_state.rewrite_pr_job_id = None
 
     uploaded_file = st.file_uploader("Excelファイルを選択してください（A列=職種名, B列=キャッチコピー）※1行目は見出し扱いになります", type=["xlsx"])
     num_variations = st.slider("複製数を指定してください（2〜10）", min_value=2, max_value=10, value=3)
+    concurrency = st.slider("同時リクエスト数", min_value=1, max_value=32, value=DEFAULT_CONCURRENCY)
+    resume = st.checkbox("中断したジョブがあれば続きから再開する（同じファイル・同じ設定の場合）", value=True)
+    multi = st.checkbox("複製のキャッチコピーをまとめて1回のリクエストで生成する（呼び出し回数と入力トークンを削減）")
+    share_variations = st.checkbox("同じ内容の行には同じ複製を使う（API呼び出しを節約）", value=False)
+    regenerate_similar = st.checkbox("元の職種名・キャッチコピーや他の複製とほぼ同じものは作り直す", value=True)
+    batch_mode = st.checkbox("バッチモード（Batch APIで送信し、完了まで待機する・夜間の大量処理向け）")
 
     if uploaded_file is not None:
         st.success("ファイルを読み込みました ✅")
-        df = pd.read_excel(uploaded_file, engine="openpyxl")
-        df.replace({r"_x000D_": "", r"\r": "", r"\n": ""}, regex=True, inplace=True)
-        st.dataframe(df.head())
-
-        if st.button("処理を開始する"):
-            expanded_rows = []
-
-            for i in range(len(df)):
-                title = str(df.iloc[i, 0])
-                detail = str(df.iloc[i, 1])
-
-                # --- ステップ1: 職種名をAIでリスト出力 ---
-                prompt_title = f"""
-以下の職種名をもとに、求人広告で使える自然な職種名のバリエーションを、各30文字以下で、{num_variations}個作成してください。
-単語を言い換えたり、記号を変更したり、語順を変更したり、表現を言い換えて、重複しないようにしてください。
-箇条書きで出力してください。
-
-【禁止表現】
-・「募集」「募集中」「採用」といった職種名ではない表現
-・「です」「ます」といった、名称ではなく文章とみなされる表現
----
-職種名: {title}
----
-"""
-                try:
-                    response = client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt_title}],
-                        temperature=0.7
+        reader = ExcelChunkReader(uploaded_file)
+        st.dataframe(reader.preview())
+        render_estimate("rewrite_pr", uploaded_file.getvalue(), num_variations, concurrency, multi=multi, share_variations=share_variations)
+
+        start = StartButton("rewrite_pr_job_id")
+        if start.clicked:
+            # 処理はバックグラウンドのワーカーで実行し、画面は進捗を定期的に確認するだけにする
+            file_bytes = uploaded_file.getvalue()
+            runner = get_shared_runner()
+            try:
+                if batch_mode:
+                    journal, journal_id = prepare_job("rewrite_pr", file_bytes, uploaded_file.name, {"num_variations": num_variations, "batch": True}, resume)
+                    show_resume_info(journal, journal_id)
+                    job_id = runner.submit(
+                        "rewrite_pr", uploaded_file.name, rewrite_pr_batch_pipeline, BytesIO(file_bytes), num_variations,
+                        journal=journal, job_id=journal_id
+                    )
+                else:
+                    journal, journal_id = prepare_job("rewrite_pr", file_bytes, uploaded_file.name, {"num_variations": num_variations, "multi": multi, "share_variations": share_variations, "regenerate_similar": regenerate_similar}, resume)
+                    show_resume_info(journal, journal_id)
+                    job_id = runner.submit(
+                        "rewrite_pr", uploaded_file.name, rewrite_pr_pipeline, BytesIO(file_bytes), num_variations,
+                        concurrency=concurrency, multi=multi, share_variations=share_variations, regenerate_similar=regenerate_similar,
+                        journal=journal, job_id=journal_id
                     )
-                    lines = response.choices[0].message.content.strip().splitlines()
-                    variations = [re.sub(r"^[-\d\.・\s]+", "", line).strip() for line in lines if line.strip()]
-                except Exception as e:
-                    variations = [f"[ERROR] {e}" for _ in range(num_variations)]
-
-                for var_title in variations[:num_variations]:
-                    # --- ステップ2: キャッチコピーを生成 ---
-                    prompt_detail = f"""
-以下の求人広告のキャッチコピーをもとに、単語を言い換えたり、記号や語順を変更したりして、全く異なる自然な表現の新しいキャッチコピーを30文字以内で作成してください。
----
-キャッチコピー: {detail}
----
-新しいキャッチコピー:
-"""
-                    try:
-                        response = client.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt_detail}],
-                            temperature=0.7
-                        )
-                        rewritten_detail = response.choices[0].message.content.strip()
-                    except Exception as e:
-                        rewritten_detail = f"[ERROR] {e}"
-
-                    expanded_rows.append({
-                        "元の職種名": title,
-                        "元のキャッチコピー": detail,
-                        "複製の職種名": var_title,
-                        "複製のキャッチコピー": rewritten_detail
-                    })
-
-            df_result = pd.DataFrame(expanded_rows)
-            st.session_state.df_result_rewrite = df_result
+            except JobAlreadyRunning as e:
+                st.warning(f"⚠ {e}")
+            else:
+                st.session_state.rewrite_pr_job_id = job_id
+                st.session_state.df_result_rewrite = None
+                start.started()
+
+    render_job_status("rewrite_pr_job_id", "df_result_rewrite")
 
     if st.session_state.df_result_rewrite is not None:
         st.success("✅ 言い換え複製 完了！")
-        st.dataframe(st.session_state.df_result_rewrite.head(10))
-
-        excel_data = convert_df(st.session_state.df_result_rewrite)
-        st.download_button(
-            label="📥 結果をダウンロード（Excel）",
-            data=excel_data,
-            file_name="rewrite_pr_output.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
+        show_error_rows(st.session_state.df_result_rewrite)
+        st.dataframe(st.session_state.df_result_rewrite.preview)
+
+        render_result_downloads(st.session_state.df_result_rewrite, "rewrite_pr_output", "rewrite_pr")
@@ -0,0 +1,44 @@
+import os
+import sys
+
+# 画面なしで動かすときに読む secrets.toml（Streamlit と同じく、プロジェクトの設定でユーザー全体の設定を上書きする）
+SECRETS_PATHS = (
+    os.path.join(os.path.expanduser("~"), ".streamlit", "secrets.toml"),
+    os.path.join(".streamlit", "secrets.toml"),
+)
+
+_overrides = {}
+_file_secrets = None
+
+# --- 設定の読み込み（secrets.toml を基本にし、CLIなどから渡された値で上書きする） ---
+def configure(**sections):
+    # 例: configure(openai={"api_key": "...", "requests_per_minute": 100})
+    for section, values in sections.items():
+        _overrides.setdefault(section, {}).update(values)
+
+
+def _secrets():
+    # 画面から呼ばれたときは st.secrets を使い、それ以外（CLI・テスト）では streamlit を読み込まずに直接読む
+    global _file_secrets
+    if "streamlit" in sys.modules:
+        import streamlit as st
+        return st.secrets
+    if _file_secrets is None:
+        import tomllib
+        secrets = {}
+        for path in SECRETS_PATHS:
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    secrets.update(tomllib.load(f))
+        _file_secrets = secrets
+    return _file_secrets
+
+
+def get_settings(section):
+    # secrets.toml が無い環境（CLI・cron）でも動くように、見つからなければ空の設定として扱う
+    try:
+        values = dict(_secrets().get(section, {}))
+    except FileNotFoundError:
+        values = {}
+    values.update(_overrides.get(section, {}))
+    return values
@@ -0,0 +1,215 @@
+import asyncio
+import re
+from collections import namedtuple
+from prompts import render
+from settings import get_settings
+
+NGRAM = 2
+NUM_PERMUTATIONS = 64
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_SEED = 20240601
+# 1回の配列計算で比較する行数（メモリ使用量を一定に抑える）
+SCORE_BLOCK_ROWS = 1000
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_MAX_REGENERATIONS = 2
+SOURCE_COLUMN = "元の職種名"
+VARIATION_COLUMN = "複製の職種名"
+COPY_SOURCE_COLUMN = "元のキャッチコピー"
+COPY_VARIATION_COLUMN = "複製のキャッチコピー"
+SCORE_COLUMN = "複製の独自性"
+
+_SPACES = re.compile(r"\s+")
+_permutations = None
+
+# numpy は pandas と同じく読み込みに時間がかかるため、実際に使う時点で import する
+
+# --- 文字n-gramのMinHash（全行の職種名をまとめて配列で計算する） ---
+def _hash_parameters():
+    global _permutations
+    if _permutations is None:
+        import numpy as np
+        rng = np.random.default_rng(MINHASH_SEED)
+        _permutations = (
+            rng.integers(1, MINHASH_PRIME, NUM_PERMUTATIONS, dtype=np.uint64),
+            rng.integers(0, MINHASH_PRIME, NUM_PERMUTATIONS, dtype=np.uint64),
+        )
+    return _permutations
+
+
+def minhash_signatures(texts):
+    # 各テキストを文字n-gramの集合にし、NUM_PERMUTATIONS 個のハッシュ関数それぞれの最小値を署名とする。
+    # 2つの署名の一致率は、n-gram集合のJaccard係数の推定値になる
+    # （全テキストを1つの文字コード配列にし、n-gramの切り出しもハッシュも配列演算で行う）
+    import numpy as np
+    cleaned = [_SPACES.sub("", text) or "\0" for text in texts]
+    lengths = np.fromiter((len(text) for text in cleaned), dtype=np.int64, count=len(cleaned))
+    codes = np.frombuffer("".join(cleaned).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    ends = np.cumsum(lengths)
+    owners = np.repeat(np.arange(len(cleaned)), lengths)
+    positions = np.arange(len(codes))
+    text_ends = ends[owners]
+    last = positions == text_ends - 1
+    # 各位置から NGRAM 文字を1つの整数にまとめる。テキストの末尾より先は 0 で埋め、次のテキストの文字は使わない
+    grams = codes.copy()
+    for offset in range(1, NGRAM):
+        following = np.zeros(len(codes), dtype=np.uint64)
+        inside = positions + offset < text_ends
+        following[inside] = codes[positions[inside] + offset]
+        grams = grams * 0x110000 + following
+    # テキストの末尾をまたぐ n-gram は使わない。
+    # NGRAM 文字に満たない短いテキストは、末尾を 0 で埋めたテキスト全体を1つの n-gram とする
+    keep = positions + (NGRAM - 1) < text_ends
+    keep |= (lengths[owners] < NGRAM) & last
+    grams = grams[keep] % MINHASH_PRIME
+    a, b = _hash_parameters()
+    values = (grams[:, None] * a + b) % MINHASH_PRIME
+    counts = np.bincount(owners[keep], minlength=len(cleaned))
+    return np.minimum.reduceat(values, np.concatenate(([0], np.cumsum(counts)[:-1])), axis=0)
+
+
+def score_groups(groups, threshold=DEFAULT_THRESHOLD):
+    # groups は (元のテキスト, [複製, ...]) のリスト。
+    # 複製ごとに (独自性スコア, 作り直す対象か) を返す。スコアは 1 - 最も似ている相手との類似度で、
+    # 作り直す対象は、元のテキストか先に並んでいる複製と threshold 以上似ているもの（後から出た方だけを直す）
+    import numpy as np
+    scores = []
+    duplicates = []
+    for start in range(0, len(groups), SCORE_BLOCK_ROWS):
+        block = groups[start:start + SCORE_BLOCK_ROWS]
+        width = max(len(variations) for _, variations in block) + 1
+        texts = []
+        slots = []
+        for row, (source, variations) in enumerate(block):
+            for column, text in enumerate([source] + list(variations)):
+                # エラーの項目は比較しない
+                if isinstance(text, str) and not text.startswith("[ERROR]"):
+                    texts.append(text)
+                    slots.append(row * width + column)
+        valid = np.zeros(len(block) * width, dtype=bool)
+        valid[slots] = True
+        valid = valid.reshape(len(block), width)
+        signatures = np.zeros((len(block) * width, NUM_PERMUTATIONS), dtype=np.uint64)
+        if texts:
+            signatures[slots] = minhash_signatures(texts)
+        signatures = signatures.reshape(len(block), width, NUM_PERMUTATIONS)
+
+        # 行ごとに全ての組み合わせの類似度を一度に求める（行 × 項目 × 項目）
+        similarity = (signatures[:, :, None, :] == signatures[:, None, :, :]).mean(axis=3)
+        similarity[~(valid[:, :, None] & valid[:, None, :])] = 0.0
+        similarity[:, np.arange(width), np.arange(width)] = 0.0
+        earlier = np.tril(np.ones((width, width), dtype=bool), k=-1)
+        block_scores = 1.0 - similarity.max(axis=2)
+        block_duplicates = (np.where(earlier, similarity, 0.0).max(axis=2) >= threshold) & valid
+        for row, (_, variations) in enumerate(block):
+            count = len(variations)
+            scores.append([float(score) if ok else None for score, ok in zip(block_scores[row, 1:count + 1], valid[row, 1:count + 1])])
+            duplicates.append(block_duplicates[row, 1:count + 1].tolist())
+    return scores, duplicates
+
+
+def combine_scores(field_scores):
+    # 複数の列を比べた場合は、列ごとのスコアのうち最も低いものをその複製のスコアにする
+    return [
+        [min((score for score in scores if score is not None), default=None) for scores in zip(*row_scores)]
+        for row_scores in zip(*field_scores)
+    ]
+
+
+def format_score(score):
+    return round(score, 3) if score is not None else ""
+
+
+# --- 似すぎた複製だけを作り直す ---
+def similarity_settings():
+    settings = get_settings("similarity")
+    return settings.get("threshold", DEFAULT_THRESHOLD), settings.get("max_regenerations", DEFAULT_MAX_REGENERATIONS)
+
+
+def existing_texts(row_group, index, source, variation):
+    # 元のテキストと、同じ行の他の複製（エラーの項目は除く）を「既出の案」として渡す
+    texts = [row_group[index][source]] + [row[variation] for i, row in enumerate(row_group) if i != index]
+    return [text for text in texts if not text.startswith("[ERROR]")]
+
+
+def first_line(content):
+    lines = [line.lstrip("-・0123456789. ").strip() for line in content.splitlines() if line.strip()]
+    return lines[0] if lines else None
+
+
+def build_prompt_title_retry(title, existing):
+    return render("variation.title_retry", title=title, existing="\n".join(f"・{text}" for text in existing))
+
+
+def build_prompt_copy_retry(copy, existing):
+    return render("variation.copy_retry", detail=copy, existing="\n".join(f"・{text}" for text in existing))
+
+
+async def regenerate_title(engine, row_group, index, attempt):
+    # 元の職種名や既出の案と異なる職種名を1件だけ生成する
+    title = row_group[index][SOURCE_COLUMN]
+    prompt = build_prompt_title_retry(title, existing_texts(row_group, index, SOURCE_COLUMN, VARIATION_COLUMN))
+    content = await engine.complete(prompt, temperature=0.9, variation=index + attempt * len(row_group), stage="title_retry", varied=True)
+    return first_line(content)
+
+
+async def regenerate_copy(engine, row_group, index, attempt):
+    copy = row_group[index][COPY_SOURCE_COLUMN]
+    prompt = build_prompt_copy_retry(copy, existing_texts(row_group, index, COPY_SOURCE_COLUMN, COPY_VARIATION_COLUMN))
+    content = await engine.complete(prompt, temperature=0.9, variation=index + attempt * len(row_group), stage="copy_retry", varied=True)
+    return first_line(content)
+
+
+# 比べる列: 元の列名・複製の列名・作り直す関数 (engine, 行の出力, 位置, 回数) -> 新しいテキスト。
+# on_replaced(row, index) を指定すると、差し替えた行の残りの列を作り直せる
+CheckedField = namedtuple("CheckedField", ["source", "variation", "regenerate", "on_replaced"], defaults=(None,))
+TITLE_FIELD = CheckedField(SOURCE_COLUMN, VARIATION_COLUMN, regenerate_title)
+COPY_FIELD = CheckedField(COPY_SOURCE_COLUMN, COPY_VARIATION_COLUMN, regenerate_copy)
+
+
+def score_fields(groups, fields, threshold):
+    # 列ごとに (スコア, 作り直す対象か) を返す
+    return [
+        score_groups([(group[0][field.source], [row[field.variation] for row in group]) for group in groups], threshold)
+        for field in fields
+    ]
+
+
+async def refine_variations(engine, row_groups, regenerate=True, fields=(TITLE_FIELD,)):
+    # row_groups は元の行ごとの出力行のリスト。fields の列ごとに似すぎた複製を上限回数まで作り直し、
+    # 最後に全ての出力行へ独自性スコアを書き込む
+    threshold, max_regenerations = similarity_settings()
+    rounds = max_regenerations if regenerate else 0
+    groups = [group for group in row_groups if group]
+    for attempt in range(rounds + 1):
+        with engine.metrics.timer("similarity"):
+            results = score_fields(groups, fields, threshold)
+        targets = [
+            (field, group, index)
+            for field, (_, duplicates) in zip(fields, results)
+            for group, flags in zip(groups, duplicates)
+            for index, flag in enumerate(flags) if flag
+        ]
+        if attempt == 0:
+            engine.metrics.incr("near_duplicates", len(targets))
+        if attempt == rounds or not targets:
+            break
+
+        async def replace(field, group, index):
+            try:
+                new_text = await field.regenerate(engine, group, index, attempt + 1)
+            except Exception:
+                # 作り直しに失敗した場合は元の複製をそのまま使う
+                return
+            if new_text:
+                group[index][field.variation] = new_text
+                engine.metrics.incr("regenerated")
+                if field.on_replaced is not None:
+                    await field.on_replaced(group[index], index)
+
+        await asyncio.gather(*(replace(field, group, index) for field, group, index in targets))
+
+    engine.metrics.incr("near_duplicates_left", len(targets))
+    for group, group_scores in zip(groups, combine_scores([scores for scores, _ in results])):
+        for row, score in zip(group, group_scores):
+            row[SCORE_COLUMN] = format_score(score)
+    return [row for group in row_groups for row in group]
@@ -1,23 +1,192 @@
 import streamlit as st
-import pandas as pd
-from openai import OpenAI
 from io import BytesIO
-import fugashi
+import asyncio
 import random
 import json
+import math
 import os
-
-# OpenAI APIキーの設定
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-
-tagger = fugashi.Tagger()
-
-# --- 共通関数 ---
-def convert_df(df):
-    from io import BytesIO
-    output = BytesIO()
-    df.to_excel(output, index=False, engine="openpyxl")
-    return output.getvalue()
+from llm_engine import LLMEngine, DEFAULT_CONCURRENCY, normalize_prompt
+from excel_io import ExcelChunkReader, StreamingExcelWriter
+from job_journal import run_chunk
+from job_runner import JobAlreadyRunning, ProgressCounter, StartButton, get_shared_runner, prepare_job, render_estimate, render_job_status, render_result_downloads, show_error_rows, show_resume_info
+from packing import RequestPacker, DEFAULT_TOKEN_BUDGET, DEFAULT_MAX_ITEMS
+from prompts import PromptEstimate, TEMPLATES, detail_token_budget, field_tokens, render, trim_to_budget
+from tokenizer import get_shared_tokenizer
+
+PACKED_PROMPT_TOKENS = 250
+PACKED_ITEM_OVERHEAD_TOKENS = 30
+PACKED_OUTPUT_TOKENS_PER_ITEM = 120
+# 見積もり用: 1行から分割される作業のおおよその数と、作業名のトークン数
+ESTIMATED_TASKS_PER_ROW = 3
+ESTIMATED_TASK_TOKENS = 15
+
+# --- AI呼び出し ---
+def build_prompt_analyze(title, detail):
+    return render("split.analyze", title=title, detail=detail)
+
+async def analyze_row(engine, title, detail):
+    try:
+        return await engine.complete(build_prompt_analyze(title, detail), temperature=0.3, stage="analyze")
+    except Exception as e:
+        return f"[ERROR] {e}"
+
+# --- 複数行をまとめた作業分割（パック処理） ---
+def build_prompt_analyze_packed(items):
+    budget = detail_token_budget()
+    blocks = "\n".join(
+        f"[求人ID: {i + 1}]\n職種: {title}\n仕事内容: {trim_to_budget(detail, budget)}\n" for i, (title, detail) in enumerate(items)
+    )
+    return render("split.analyze_packed", blocks=blocks)
+
+def parse_analyze_packed(content, count):
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    results = {}
+    for i in range(count):
+        tasks = data.get(str(i + 1))
+        if isinstance(tasks, list):
+            tasks = [task.strip() for task in tasks if isinstance(task, str) and task.strip()]
+            if tasks:
+                # 単独呼び出しと同じ箇条書き形式にそろえる
+                results[i] = "\n".join(f"- {task}" for task in tasks)
+    return results
+
+def estimate_packed_item_tokens(item):
+    title, detail = item
+    return len(title) + len(detail) + PACKED_ITEM_OVERHEAD_TOKENS + PACKED_OUTPUT_TOKENS_PER_ITEM
+
+def make_analyze_packer(engine, token_budget=None):
+    async def run_packed(items):
+        content = await engine.complete(
+            build_prompt_analyze_packed(items), temperature=0.3, response_format={"type": "json_object"}, stage="analyze_packed"
+        )
+        results = parse_analyze_packed(content, len(items))
+        for i, raw_result in results.items():
+            engine.remember(build_prompt_analyze(*items[i]), 0.3, raw_result, stage="analyze")
+        return results
+
+    async def run_single(item):
+        return await analyze_row(engine, *item)
+
+    options = {"token_budget": token_budget} if token_budget else {}
+    return RequestPacker(run_packed, run_single, estimate_packed_item_tokens, base_tokens=PACKED_PROMPT_TOKENS, **options)
+
+async def analyze_row_packed(engine, packer, title, detail):
+    # 以前に処理した行はキャッシュから返し、残りだけをまとめて送る（同じ求人は1件としてまとめる）
+    prompt = build_prompt_analyze(title, detail)
+    cached = engine.lookup(prompt, 0.3, stage="analyze")
+    if cached is not None:
+        return cached
+    return await engine.deduplicate(("packed", normalize_prompt(prompt)), lambda: packer.submit((title, detail)))
+
+async def describe_task(engine, task, original_detail):
+    prompt = render("split.describe", detail=original_detail, task=task)
+    try:
+        return await engine.complete(prompt, temperature=0.3, stage="describe")
+    except Exception as e:
+        return f"[ERROR] {e}"
+
+async def rewrite_for_job_ad(engine, original_explanation):
+    prompt = render("split.rewrite_ad", explanation=original_explanation)
+    try:
+        return await engine.complete(prompt, temperature=0.7, stage="rewrite_ad")
+    except Exception as e:
+        return f"[ERROR] {e}"
+
+# --- 職種名の整形 ---
+def extract_prefix_suffix(title):
+    words = get_shared_tokenizer().surfaces(title)
+    prefix = ''
+    suffix = ''
+    for i in range(len(words)):
+        surface = words[i]
+        if surface.endswith("での") or surface.endswith("の"):
+            prefix = ''.join(words[:i+1])
+            break
+    if ' ' in title:
+        suffix = title.split()[-1]
+    return prefix, suffix
+
+def format_task(task, prefix, suffix):
+    result = f"{prefix}{task}"
+    if suffix:
+        result += f"　{suffix}"
+    return result
+
+async def process_row(engine, title, detail, columns, packer=None):
+    if packer is not None:
+        raw_result = await analyze_row_packed(engine, packer, title, detail)
+    else:
+        raw_result = await analyze_row(engine, title, detail)
+    tasks = [line.lstrip("-・0123456789. ").strip() for line in raw_result.splitlines() if line.strip()]
+    with engine.metrics.timer("tokenize"):
+        prefix, suffix = extract_prefix_suffix(title)
+
+    async def process_task(task):
+        # 各作業は前段の応答が返った時点で次の段へ進む（列全体の完了を待たない）
+        formatted = format_task(task, prefix, suffix)
+        explanation = await describe_task(engine, formatted, detail)
+        ad_text = await rewrite_for_job_ad(engine, explanation)
+        return {
+            columns[0]: title,
+            columns[1]: detail,
+            "分割後の職種名": formatted,
+            "分割後の仕事詳細": ad_text
+        }
+
+    return await asyncio.gather(*(process_task(task) for task in tasks))
+
+# --- 実行前の見積もり（作業分割は同じ求人をまとめて1回だけ呼び出す） ---
+def estimate_split(frame, concurrency=DEFAULT_CONCURRENCY, packed=False):
+    unique = frame.iloc[:, :2].drop_duplicates()
+    titles = field_tokens(unique.iloc[:, 0])
+    details = field_tokens(unique.iloc[:, 1], trim=True)
+    estimate = PromptEstimate(len(frame), concurrency)
+    if packed:
+        # まとめる件数は RequestPacker と同じく、件数の上限とトークン予算で決まる
+        variable = int((titles + details).sum()) + len(unique) * PACKED_ITEM_OVERHEAD_TOKENS
+        item_tokens = variable + len(unique) * PACKED_OUTPUT_TOKENS_PER_ITEM
+        calls = max(math.ceil(len(unique) / DEFAULT_MAX_ITEMS), math.ceil(item_tokens / (DEFAULT_TOKEN_BUDGET - PACKED_PROMPT_TOKENS)))
+        estimate.add("split.analyze_packed", calls, variable, output_tokens=len(unique) * PACKED_OUTPUT_TOKENS_PER_ITEM // max(calls, 1))
+    else:
+        estimate.add("split.analyze", len(unique), (titles + details).sum())
+    tasks = len(unique) * ESTIMATED_TASKS_PER_ROW
+    estimate.add("split.describe", tasks, details.sum() * ESTIMATED_TASKS_PER_ROW + tasks * ESTIMATED_TASK_TOKENS)
+    estimate.add("split.rewrite_ad", tasks, tasks * TEMPLATES["split.describe"].output_tokens)
+    return estimate
+
+# --- 業務分割パイプライン（Streamlitに依存しないのでバックグラウンドで実行できる） ---
+def split_pipeline(file, concurrency=DEFAULT_CONCURRENCY, packed=False, journal=None, job_id=None, on_progress=None, metrics=None):
+    engine = LLMEngine(concurrency=concurrency, metrics=metrics)
+    reader = ExcelChunkReader(file, metrics=engine.metrics)
+    columns = reader.columns
+    writer = StreamingExcelWriter([columns[0], columns[1], "分割後の職種名", "分割後の仕事詳細"], metrics=engine.metrics)
+    counter = ProgressCounter(reader.count_rows(), on_progress, engine.metrics)
+    packer = make_analyze_packer(engine) if packed else None
+    tokenizer = get_shared_tokenizer()
+
+    async def run_row(title, detail):
+        return await process_row(engine, title, detail, columns, packer)
+
+    # チャンク単位で処理して書き出すため、入力サイズに関係なくメモリ使用量は一定になる
+    offset = 0
+    try:
+        for chunk in reader.iter_chunks():
+            # 職種名はチャンク単位でまとめて解析しておき、行ごとの処理ではキャッシュから取り出す
+            with engine.metrics.timer("tokenize_batch"):
+                tokenizer.tokenize_many([title for title, _ in chunk])
+            writer.append_rows(engine.run(run_chunk(chunk, offset, run_row, journal, job_id, counter.advance)))
+            offset += len(chunk)
+    finally:
+        engine.close()
+
+    if journal is not None:
+        journal.finish(job_id)
+    return writer.close()
 
 # --- 業務分割処理 ---
 def job_split():
@@ -25,151 +194,43 @@ def job_split():
 
     if "df_result_split" not in st.session_state:
         st.session_state.df_result_split = None
-
-    def analyze_row(title, detail):
-        prompt = f"""
-以下は求人広告の情報です。
-この仕事に含まれる具体的な作業内容を、箇条書きでリストアップしてください。
-箇条書きの各項目は、日本語で20文字以内に簡潔にまとめてください。
-作業名だけを出力してください（前置きや補足は不要です）。
----
-職種: {title}
-仕事内容: {detail}
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            error_msg = str(e)
-            if "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
-                st.error("⚠ OpenAIの利用上限に達しています。しばらく時間をおいて再実行してください。")
-            return f"[ERROR] {e}"
-
-    def extract_prefix_suffix(title):
-        words = list(tagger(title))
-        prefix = ''
-        suffix = ''
-        for i in range(len(words)):
-            surface = words[i].surface
-            if surface.endswith("での") or surface.endswith("の"):
-                prefix = ''.join([w.surface for w in words[:i+1]])
-                break
-        if ' ' in title:
-            suffix = title.split()[-1]
-        return prefix, suffix
-
-    def format_task(task, prefix, suffix):
-        result = f"{prefix}{task}"
-        if suffix:
-            result += f"　{suffix}"
-        return result
-
-    def expand_to_rows(df):
-        rows = []
-        for i in range(len(df)):
-            title = str(df.iloc[i, 0])
-            detail = str(df.iloc[i, 1])
-            raw_result = analyze_row(title, detail)
-            tasks = [line.lstrip("-・0123456789. ").strip() for line in raw_result.splitlines() if line.strip()]
-            prefix, suffix = extract_prefix_suffix(title)
-            for task in tasks:
-                formatted = format_task(task, prefix, suffix)
-                rows.append({
-                    df.columns[0]: title,
-                    df.columns[1]: detail,
-                    "分割後の職種名": formatted
-                })
-        return pd.DataFrame(rows)
-
-    def describe_task(task, original_detail):
-        prompt = f"""
-以下の仕事内容の説明をもとに、「{task}」という作業が具体的に何を意味するのかを簡潔に説明してください。
----
-仕事内容の説明: {original_detail}
----
-作業の説明:
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            error_msg = str(e)
-            if "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
-                st.error("⚠ OpenAIの利用上限に達しています。しばらく時間をおいて再実行してください。")
-            return f"[ERROR] {e}"
-
-    def rewrite_for_job_ad(original_explanation):
-        prompt = f"""
-以下の説明文を、求人広告で使用する自然な仕事の説明文に書き換えてください。
-以下のような文章のスタイルを参考にしてください。
-
-【例文1】
-製造装置への部材セットをお任せします。カメラの製造工程において、製造装置に必要な部材をセットする作業で、大小様々な材料を装置にセットして、製品の製造をスムーズに進める役割のお仕事です。
-
-【例文2】
-完成品の検査業務をお任せします。製造された製品にキズや不備がないかを確認するお仕事で、目視や道具を使って丁寧にチェックする作業です。
-
-【例文3】
-部品の梱包作業をお任せします。指定された部品をまとめ、箱に詰めてラベルを貼る作業で、出荷準備を整える大切なお仕事です。
-
----
-元の説明: {original_explanation}
----
-仕事の説明文（求人広告向け）:
-"""
-        try:
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.7
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            error_msg = str(e)
-            if "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
-                st.error("⚠ OpenAIの利用上限に達しています。しばらく時間をおいて再実行してください。")
-            return f"[ERROR] {e}"
+    if "split_job_id" not in st.session_state:
+        st.session_state.split_job_id = None
 
     uploaded_file = st.file_uploader("Excelファイルを選択してください（A列=職種名, B列=仕事内容）※1行目は見出し扱いになります", type=["xlsx"])
+    concurrency = st.slider("同時リクエスト数", min_value=1, max_value=32, value=DEFAULT_CONCURRENCY)
+    resume = st.checkbox("中断したジョブがあれば続きから再開する（同じファイル・同じ設定の場合）", value=True)
+    packed = st.checkbox("複数行をまとめて1回のリクエストで作業分割する（短い求人が多い場合に高速化）")
 
     if uploaded_file is not None and st.session_state.df_result_split is None:
-        df = pd.read_excel(uploaded_file, engine="openpyxl")
-        df.replace({r"_x000D_": "", r"\r": "", r"\n": ""}, regex=True, inplace=True)
+        reader = ExcelChunkReader(uploaded_file)
 
         st.success("ファイルを読み込みました ✅")
         st.write("📄 アップロード内容（先頭5行）:")
-        st.dataframe(df.head())
-
-        df_expanded = expand_to_rows(df)
-        st.info("作業の詳細をAIで説明中...")
-        df_expanded["分割後の仕事詳細"] = df_expanded.apply(
-            lambda row: describe_task(row["分割後の職種名"], row[df.columns[1]]), axis=1
-        )
-
-        st.info("求人広告向けの案内文に変換中...")
-        df_expanded["案内文"] = df_expanded["分割後の仕事詳細"].apply(rewrite_for_job_ad)
-
-        df_result = df_expanded[[df.columns[0], df.columns[1], "分割後の職種名", "案内文"]].copy()
-        df_result.rename(columns={"案内文": "分割後の仕事詳細"}, inplace=True)
-
-        st.session_state.df_result_split = df_result
+        st.dataframe(reader.preview())
+        render_estimate("split", uploaded_file.getvalue(), concurrency=concurrency, packed=packed)
+
+        # 見積もりを確認してから開始できるよう、アップロードしただけでは処理を始めない
+        start = StartButton("split_job_id")
+        if start.clicked:
+            file_bytes = uploaded_file.getvalue()
+            try:
+                journal, job_id = prepare_job("job_split", file_bytes, uploaded_file.name, {}, resume)
+                show_resume_info(journal, job_id)
+                st.session_state.split_job_id = get_shared_runner().submit(
+                    "job_split", uploaded_file.name, split_pipeline, BytesIO(file_bytes),
+                    concurrency=concurrency, packed=packed, journal=journal, job_id=job_id
+                )
+            except JobAlreadyRunning as e:
+                st.warning(f"⚠ {e}")
+            else:
+                start.started()
+
+    render_job_status("split_job_id", "df_result_split")
 
     if st.session_state.df_result_split is not None:
         st.success("✅ 全ステップ完了！")
-        st.dataframe(st.session_state.df_result_split.head(10))
-
-        excel_data = convert_df(st.session_state.df_result_split)
-        st.download_button(
-            label="📥 結果をダウンロード（Excel）",
-            data=excel_data,
-            file_name="ai_job_ads_output.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
\ No newline at end of file
+        show_error_rows(st.session_state.df_result_split)
+        st.dataframe(st.session_state.df_result_split.preview)
+
+        render_result_downloads(st.session_state.df_result_split, "ai_job_ads_output", "split")
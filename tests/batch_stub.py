@@ -0,0 +1,100 @@
+import itertools
+import json
+import random
+from types import SimpleNamespace
+
+# --- Batch APIのローカルスタブ（APIを呼ばずにバッチモードを検証するため） ---
+def default_responder(body):
+    prompt = body["messages"][0]["content"]
+    if "箇条書き" in prompt:
+        return "\n".join(f"- スタブ職種名{i + 1}" for i in range(10))
+    return f"スタブ応答: {prompt.strip().splitlines()[-1]}"
+
+
+class _Files:
+    def __init__(self, store):
+        self._store = store
+
+    def create(self, file, purpose):
+        data = file[1] if isinstance(file, tuple) else file.read()
+        file_id = f"file-{next(self._store.ids)}"
+        self._store.stored_files[file_id] = data.decode("utf-8") if isinstance(data, bytes) else data
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def content(self, file_id):
+        return SimpleNamespace(text=self._store.stored_files[file_id])
+
+
+class _Batches:
+    def __init__(self, store):
+        self._store = store
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch_id = f"batch-{next(self._store.ids)}"
+        self._store.stored_batches[batch_id] = {"input_file_id": input_file_id, "polls": 0, "metadata": metadata, "status": None}
+        return self.retrieve(batch_id, count_poll=False)
+
+    def cancel(self, batch_id):
+        state = self._store.stored_batches[batch_id]
+        if state["status"] is None:
+            state["status"] = "cancelled"
+        self._store.cancelled.append(batch_id)
+        return self.retrieve(batch_id, count_poll=False)
+
+    def retrieve(self, batch_id, count_poll=True):
+        state = self._store.stored_batches[batch_id]
+        if count_poll:
+            state["polls"] += 1
+        lines = [line for line in self._store.stored_files[state["input_file_id"]].splitlines() if line.strip()]
+        if state["status"] is None and state["polls"] > self._store.polls_until_complete:
+            # metadata の stage ごとに終了状態を変えられる（failed / expired の検証用）
+            state["status"] = self._store.final_statuses.get((state["metadata"] or {}).get("stage"), "completed")
+            if state["status"] == "completed":
+                state["output_file_id"] = self._store.complete(lines)
+        status = state["status"] or ("validating" if state["polls"] == 0 else "in_progress")
+        completed = len(lines) if status == "completed" else 0
+        return SimpleNamespace(
+            id=batch_id,
+            status=status,
+            output_file_id=state.get("output_file_id"),
+            error_file_id=None,
+            metadata=state["metadata"],
+            request_counts=SimpleNamespace(total=len(lines), completed=completed, failed=0)
+        )
+
+
+class LocalBatchClient:
+    def __init__(self, responder=default_responder, polls_until_complete=1, final_statuses=None, shuffle_output=False):
+        self.responder = responder
+        self.polls_until_complete = polls_until_complete
+        self.final_statuses = final_statuses or {}
+        # 実際の Batch API と同じく、出力ファイルの行は入力の順番どおりとは限らない
+        self.shuffle_output = shuffle_output
+        self.ids = itertools.count(1)
+        self.stored_files = {}
+        self.stored_batches = {}
+        self.cancelled = []
+        self.files = _Files(self)
+        self.batches = _Batches(self)
+
+    def requests_of(self, batch_id):
+        text = self.stored_files[self.stored_batches[batch_id]["input_file_id"]]
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    def complete(self, lines):
+        output = []
+        for line in lines:
+            request = json.loads(line)
+            output.append(json.dumps({
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {"choices": [{"message": {"role": "assistant", "content": self.responder(request["body"])}}]}
+                },
+                "error": None
+            }, ensure_ascii=False))
+        if self.shuffle_output:
+            random.Random(0).shuffle(output)
+        file_id = f"file-{next(self.ids)}"
+        self.stored_files[file_id] = "\n".join(output) + "\n"
+        return file_id
@@ -0,0 +1,159 @@
+from io import BytesIO
+import pytest
+from openpyxl import Workbook
+import batch_api
+from batch_api import run_variation_batches
+from batch_stub import LocalBatchClient
+from job_journal import JobJournal
+from job_runner import JobCancelled
+from rewrite_with_detail import build_prompt_detail, build_prompt_title, parse_variations, rewrite_batch_pipeline
+from rewrite_with_pr import rewrite_pr_batch_pipeline
+
+
+# プロンプトの「項目: 値」から、どの依頼への応答かが分かる文面を返す
+def echo_responder(body):
+    prompt = body["messages"][0]["content"]
+    fields = dict(line.split(": ", 1) for line in prompt.splitlines() if ": " in line)
+    if "作成する個数" in fields:
+        count = int(fields["作成する個数"].rstrip("個"))
+        return "\n".join(f"- {fields['職種名']}の案{k + 1}" for k in range(count))
+    if "仕事内容" in fields:
+        return f"{fields['職種名']}の案内文"
+    return f"{fields['キャッチコピー']}の新案"
+
+
+def run_batches(client, titles, num_variations=3, **kwargs):
+    details = [f"{title}の仕事" for title in titles]
+    return run_variation_batches(
+        client, titles, details, num_variations, build_prompt_title, build_prompt_detail, parse_variations,
+        poll_interval=0, **kwargs
+    )
+
+
+def make_workbook(rows, header=("職種名", "仕事内容")):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(list(header))
+    for row in rows:
+        sheet.append(list(row))
+    output = BytesIO()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def test_detail_batch_uses_titles_from_title_batch():
+    client = LocalBatchClient(echo_responder)
+    results = run_batches(client, ["営業", "事務"])
+    assert results == [
+        [(f"{title}の案{k}", f"{title}の案{k}の案内文") for k in (1, 2, 3)] for title in ("営業", "事務")
+    ]
+    stages = [state["metadata"]["stage"] for state in client.stored_batches.values()]
+    assert stages == ["title", "detail"]
+
+
+def test_results_are_matched_by_custom_id():
+    client = LocalBatchClient(echo_responder, shuffle_output=True)
+    titles = [f"職種{i}" for i in range(30)]
+    results = run_batches(client, titles, num_variations=2)
+    for title, variations in zip(titles, results):
+        assert variations == [(f"{title}の案{k}", f"{title}の案{k}の案内文") for k in (1, 2)]
+
+
+def test_requests_over_the_limit_are_split_into_several_batches(monkeypatch):
+    monkeypatch.setattr(batch_api, "MAX_BATCH_REQUESTS", 4)
+    client = LocalBatchClient(echo_responder)
+    titles = [f"職種{i}" for i in range(5)]
+    results = run_batches(client, titles)
+    # 職種名 5件 → 2バッチ、案内文 15件 → 4バッチ
+    assert len(client.stored_batches) == 6
+    assert all(len(client.requests_of(batch_id)) <= 4 for batch_id in client.stored_batches)
+    custom_ids = [request["custom_id"] for batch_id in client.stored_batches for request in client.requests_of(batch_id)]
+    assert len(custom_ids) == len(set(custom_ids)) == 20
+    for title, variations in zip(titles, results):
+        assert variations == [(f"{title}の案{k}", f"{title}の案{k}の案内文") for k in (1, 2, 3)]
+
+
+def test_expired_title_batch_turns_every_row_into_errors():
+    client = LocalBatchClient(echo_responder, final_statuses={"title": "expired"})
+    results = run_batches(client, ["営業", "事務"], num_variations=2)
+    for variations in results:
+        assert len(variations) == 2
+        for var_title, detail in variations:
+            assert var_title.startswith("[ERROR]") and "expired" in var_title
+            assert detail == var_title
+    # エラーの職種名で案内文のバッチは送らない
+    assert len(client.stored_batches) == 1
+
+
+def test_failed_detail_batch_keeps_titles_and_marks_details_as_errors():
+    client = LocalBatchClient(echo_responder, final_statuses={"detail": "failed"})
+    results = run_batches(client, ["営業"], num_variations=2)
+    assert [var_title for var_title, _ in results[0]] == ["営業の案1", "営業の案2"]
+    assert all(detail.startswith("[ERROR] batch ") and detail.endswith(" failed") for _, detail in results[0])
+
+
+def test_cancelling_the_job_cancels_the_running_batch():
+    client = LocalBatchClient(echo_responder, polls_until_complete=5)
+
+    def on_poll(completed, total):
+        raise JobCancelled()
+
+    with pytest.raises(JobCancelled):
+        run_batches(client, ["営業"], on_poll=on_poll)
+    assert client.cancelled == list(client.stored_batches)
+    assert client.batches.retrieve(client.cancelled[0]).status == "cancelled"
+
+
+def test_resumed_job_reattaches_to_saved_batches(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    client = LocalBatchClient(echo_responder)
+    first = run_batches(client, ["営業", "事務"], journal=journal, job_id="job")
+    assert set(journal.load_batches("job")) == {"title-0", "detail-0"}
+    second = run_batches(client, ["営業", "事務"], journal=journal, job_id="job")
+    assert second == first
+    assert len(client.stored_batches) == 2
+
+
+def test_cancelled_batch_is_submitted_again_on_resume(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    client = LocalBatchClient(echo_responder, polls_until_complete=5)
+
+    def on_poll(completed, total):
+        raise JobCancelled()
+
+    with pytest.raises(JobCancelled):
+        run_batches(client, ["営業"], journal=journal, job_id="job", on_poll=on_poll)
+    cancelled_id = journal.load_batches("job")["title-0"]
+    client.polls_until_complete = 0
+    results = run_batches(client, ["営業"], journal=journal, job_id="job")
+    assert journal.load_batches("job")["title-0"] != cancelled_id
+    assert results[0][0] == ("営業の案1", "営業の案1の案内文")
+
+
+def test_rewrite_batch_pipeline_writes_one_row_per_variation(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    journal.start("job", "job_rewrite", "input.xlsx", {})
+    progress = []
+    client = LocalBatchClient(echo_responder, polls_until_complete=0)
+    result = rewrite_batch_pipeline(
+        make_workbook([("営業", "法人営業"), ("事務", "データ入力")]), 2,
+        journal=journal, job_id="job", client=client, on_progress=lambda done, total: progress.append((done, total))
+    )
+    assert result.row_count == 4
+    assert result.error_count == 0
+    assert result.preview["複製の職種名"].tolist() == ["営業の案1", "営業の案2", "事務の案1", "事務の案2"]
+    assert result.preview["複製の仕事内容"].tolist()[0] == "営業の案1の案内文"
+    assert result.preview["複製の独自性"].notna().all()
+    assert progress[-1] == (4, 4)
+
+
+def test_rewrite_pr_batch_pipeline_reports_failed_batches_as_error_rows():
+    client = LocalBatchClient(echo_responder, polls_until_complete=0, final_statuses={"detail": "expired"})
+    result = rewrite_pr_batch_pipeline(
+        make_workbook([("営業", "やりがいのある仕事")], header=("職種名", "キャッチコピー")), 3, client=client
+    )
+    assert result.row_count == 3
+    assert result.error_count == 3
+    assert result.preview["複製の職種名"].tolist() == ["営業の案1", "営業の案2", "営業の案3"]
+    assert all(copy.startswith("[ERROR] batch ") for copy in result.preview["複製のキャッチコピー"])
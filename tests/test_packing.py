@@ -0,0 +1,89 @@
+import asyncio
+import json
+from packing import RequestPacker
+from split_module import make_analyze_packer
+
+
+def make_packer(results_for, token_budget=1000, max_items=20, base_tokens=0, estimate=lambda item: 10):
+    # run_packed はまとめた件数を記録し、results_for(items) の結果を返す
+    calls = {"packed": [], "single": []}
+
+    async def run_packed(items):
+        calls["packed"].append(list(items))
+        return results_for(items)
+
+    async def run_single(item):
+        calls["single"].append(item)
+        return f"single:{item}"
+
+    packer = RequestPacker(run_packed, run_single, estimate, base_tokens=base_tokens, token_budget=token_budget,
+                           max_items=max_items, flush_delay=0.01)
+    return packer, calls
+
+
+async def submit_all(packer, items):
+    return await asyncio.gather(*(packer.submit(item) for item in items))
+
+
+def test_only_items_missing_from_the_packed_response_are_retried():
+    packer, calls = make_packer(lambda items: {0: "packed:a", 2: "packed:c"})
+    results = asyncio.run(submit_all(packer, ["a", "b", "c"]))
+    assert results == ["packed:a", "single:b", "packed:c"]
+    assert calls["packed"] == [["a", "b", "c"]]
+    assert calls["single"] == ["b"]
+    assert packer.retried_items == 1
+
+
+def test_failed_packed_request_retries_every_item_on_its_own():
+    def fail(items):
+        raise ValueError("bad json")
+
+    packer, calls = make_packer(fail)
+    results = asyncio.run(submit_all(packer, ["a", "b"]))
+    assert results == ["single:a", "single:b"]
+    assert packer.retried_items == 2
+
+
+def test_items_per_request_follow_the_token_budget():
+    weights = {"a": 200, "b": 100, "c": 150, "d": 100, "e": 100}
+    packer, calls = make_packer(lambda items: {i: f"packed:{item}" for i, item in enumerate(items)},
+                                token_budget=350, base_tokens=50, estimate=weights.get)
+    results = asyncio.run(submit_all(packer, list(weights)))
+    # 50 + 200 + 100 = 350 で予算に達し、c (150) + d (100) の後に e を足すと予算を超える
+    assert calls["packed"] == [["a", "b"], ["c", "d"]]
+    assert calls["single"] == ["e"]
+    assert results == ["packed:a", "packed:b", "packed:c", "packed:d", "single:e"]
+
+
+def test_items_per_request_are_capped_by_max_items():
+    packer, calls = make_packer(lambda items: {i: item for i, item in enumerate(items)}, max_items=3)
+    asyncio.run(submit_all(packer, list("abcdefg")))
+    assert [len(items) for items in calls["packed"]] == [3, 3]
+    assert calls["single"] == ["g"]
+
+
+class FakeEngine:
+    # 作業分割のまとめた依頼では2件目の結果だけを欠けさせる
+    def __init__(self):
+        self.stages = []
+        self.remembered = []
+
+    async def complete(self, prompt, temperature, response_format=None, stage="llm", **kwargs):
+        self.stages.append(stage)
+        if stage == "analyze_packed":
+            return json.dumps({"1": ["検品"], "3": ["梱包", "出荷"]}, ensure_ascii=False)
+        return "- 単独の結果"
+
+    def remember(self, prompt, temperature, content, variation=0, stage="llm"):
+        self.remembered.append(content)
+
+
+def test_split_packer_retries_only_the_row_missing_from_the_json():
+    engine = FakeEngine()
+    packer = make_analyze_packer(engine)
+    packer.flush_delay = 0.01
+    items = [("倉庫作業", "検品"), ("事務", "入力"), ("軽作業", "梱包と出荷")]
+    results = asyncio.run(submit_all(packer, items))
+    assert results == ["- 検品", "- 単独の結果", "- 梱包\n- 出荷"]
+    assert engine.stages == ["analyze_packed", "analyze"]
+    assert engine.remembered == ["- 検品", "- 梱包\n- 出荷"]
@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+import rewrite_with_detail
+import rewrite_with_pr
+
+
+class FailingEngine:
+    # 職種名の1行目だけ返してストリームが切れる。complete は常に失敗する
+    def __init__(self):
+        self.stages = []
+
+    async def complete(self, prompt, temperature, stage="llm", **kwargs):
+        self.stages.append(stage)
+        raise RuntimeError("timeout")
+
+    async def stream(self, prompt, temperature, stage="llm", **kwargs):
+        self.stages.append(stage)
+        yield "- 法人営業\n"
+        raise RuntimeError("disconnected")
+
+
+@pytest.mark.parametrize("module", [rewrite_with_detail, rewrite_with_pr])
+def test_streamed_titles_that_failed_skip_the_detail_call(module):
+    engine = FailingEngine()
+    rows = asyncio.run(module.process_row(engine, "営業", "仕事の説明", 3))
+    assert engine.stages == ["title", "detail"]
+    outputs = [list(row.values())[-2:] for row in rows]
+    assert outputs[0] == ["法人営業", "[ERROR] timeout"]
+    assert outputs[1:] == [["[ERROR] disconnected", "[ERROR] disconnected"]] * 2
+
+
+@pytest.mark.parametrize("module", [rewrite_with_detail, rewrite_with_pr])
+def test_failed_title_request_in_multi_mode_skips_the_detail_calls(module):
+    engine = FailingEngine()
+    rows = asyncio.run(module.process_row(engine, "営業", "仕事の説明", 2, multi=True))
+    assert engine.stages == ["title"]
+    assert [list(row.values())[-2:] for row in rows] == [["[ERROR] timeout", "[ERROR] timeout"]] * 2
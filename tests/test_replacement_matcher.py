@@ -0,0 +1,55 @@
+import json
+import os
+import random
+import pytest
+from replacement_matcher import ReplacementMatcher, get_replacement_matcher
+
+ENTRIES = {
+    "ホールスタッフ": ["フロア係"],
+    "スタッフ": ["係員"],
+    "即日勤務": ["即日OK"],
+    "ール": ["（一致してはいけない）"],
+}
+
+
+def replace(surfaces, entries=ENTRIES):
+    return ReplacementMatcher(entries).variations(surfaces, 1, random.Random(0))[0]
+
+
+def test_compound_keys_split_into_several_morphemes_are_replaced():
+    # MeCab は「ホールスタッフ」「即日勤務」をそれぞれ2つの形態素に分ける
+    assert replace(["病院", "で", "の", "ホール", "スタッフ", "即日", "勤務"]) == "病院でのフロア係即日OK"
+
+
+def test_longest_key_wins():
+    assert replace(["ホール", "スタッフ"]) == "フロア係"
+    assert replace(["レストラン", "スタッフ"]) == "レストラン係員"
+
+
+def test_matches_start_and_end_on_morpheme_boundaries():
+    # 「ール」は「ホール」の途中から始まるので一致しない
+    assert replace(["ホール", "係"]) == "ホール係"
+    # 「スタッフ」は「スタッフ募集」の途中で終わる形態素とは一致しない
+    assert replace(["スタッフ募集"]) == "スタッフ募集"
+    assert replace(["スタッフ", "募集"]) == "係員募集"
+
+
+def test_matches_real_tokenizer_output():
+    pytest.importorskip("fugashi")
+    from tokenizer import get_shared_tokenizer
+    surfaces = get_shared_tokenizer().surfaces("病院でのホールスタッフ 即日勤務")
+    assert replace(surfaces) == "病院でのフロア係即日OK"
+
+
+def test_dictionary_is_reloaded_when_the_file_changes(tmp_path):
+    path = tmp_path / "replacement_dict.json"
+    path.write_text(json.dumps({"スタッフ": ["係員"]}, ensure_ascii=False), encoding="utf-8")
+    first = get_replacement_matcher(str(path))
+    assert get_replacement_matcher(str(path)) is first
+
+    path.write_text(json.dumps({"スタッフ": ["担当"]}, ensure_ascii=False), encoding="utf-8")
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    second = get_replacement_matcher(str(path))
+    assert second is not first
+    assert second.variations(["スタッフ"], 1)[0] == "担当"
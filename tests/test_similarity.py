@@ -0,0 +1,63 @@
+import asyncio
+from metrics import Metrics
+from similarity import COPY_FIELD, SCORE_COLUMN, TITLE_FIELD, minhash_signatures, refine_variations, score_groups
+
+
+class ScriptedEngine:
+    # 作り直しの依頼を記録し、用意した応答を順に返す
+    def __init__(self, replies):
+        self.metrics = Metrics()
+        self.replies = iter(replies)
+        self.stages = []
+
+    async def complete(self, prompt, temperature, variation=0, stage="llm", varied=False):
+        self.stages.append(stage)
+        return next(self.replies)
+
+
+def pr_rows(title, copy, variations):
+    return [
+        {"元の職種名": title, "元のキャッチコピー": copy, "複製の職種名": var_title, "複製のキャッチコピー": var_copy}
+        for var_title, var_copy in variations
+    ]
+
+
+def test_short_text_signature_does_not_depend_on_the_next_text():
+    assert (minhash_signatures(["係", "担当者"])[0] == minhash_signatures(["係", "スタッフ"])[0]).all()
+
+
+def test_identical_short_variation_is_flagged():
+    scores, duplicates = score_groups([("係", ["係", "担当者"])])
+    assert scores == [[0.0, 1.0]]
+    assert duplicates == [[True, False]]
+
+
+def test_only_the_later_of_two_similar_siblings_is_flagged():
+    _, duplicates = score_groups([("営業", ["法人営業スタッフ", "法人営業スタッフ", "倉庫内の軽作業"])])
+    assert duplicates == [[False, True, False]]
+
+
+def test_error_items_are_not_compared():
+    scores, duplicates = score_groups([("営業", ["[ERROR] timeout", "[ERROR] timeout"])])
+    assert scores == [[None, None]]
+    assert duplicates == [[False, False]]
+
+
+def test_similar_catch_copies_are_regenerated():
+    group = pr_rows("営業", "未経験から始める法人営業", [
+        ("法人営業スタッフ", "未経験から始める法人営業"),
+        ("ルート営業担当", "土日休みで働きやすい職場"),
+    ])
+    engine = ScriptedEngine(["チームで成長できる営業職"])
+    rows = asyncio.run(refine_variations(engine, [group], fields=(TITLE_FIELD, COPY_FIELD)))
+    assert engine.stages == ["copy_retry"]
+    assert [row["複製のキャッチコピー"] for row in rows] == ["チームで成長できる営業職", "土日休みで働きやすい職場"]
+    assert [row["複製の職種名"] for row in rows] == ["法人営業スタッフ", "ルート営業担当"]
+    assert all(row[SCORE_COLUMN] > 0.2 for row in rows)
+    assert engine.metrics.snapshot()["counters"]["regenerated"] == 1
+
+
+def test_score_is_the_lowest_of_the_checked_columns():
+    group = pr_rows("営業", "未経験から始める法人営業", [("法人営業スタッフ", "未経験から始める法人営業")])
+    rows = asyncio.run(refine_variations(ScriptedEngine([]), [group], regenerate=False, fields=(TITLE_FIELD, COPY_FIELD)))
+    assert rows[0][SCORE_COLUMN] == 0.0
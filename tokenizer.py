@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from settings import get_settings
+
+DEFAULT_CACHE_SIZE = 20000
+# これより少ない未解析件数ならプロセスプールを使わない（起動と転送のコストの方が大きい）
+PROCESS_POOL_MIN_TEXTS = 2000
+PROCESS_POOL_CHUNK_SIZE = 500
+
+_worker_tagger = None
+
+def _new_tagger():
+    import fugashi
+    return fugashi.Tagger()
+
+def _parse(tagger, text):
+    # ノードオブジェクトは保持せず、(表層形, 品詞) のタプルだけを返す
+    return tuple((word.surface, word.feature.pos1) for word in tagger(text))
+
+def _parse_in_worker(texts):
+    global _worker_tagger
+    if _worker_tagger is None:
+        _worker_tagger = _new_tagger()
+    return [_parse(_worker_tagger, text) for text in texts]
+
+
+# --- 形態素解析（同じ職種名を何度も解析しないようにLRUで覚えておく） ---
+class Tokenizer:
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, processes=0):
+        self.cache_size = cache_size
+        self.processes = processes
+        self.hits = 0
+        self.misses = 0
+        self._tagger = None
+        self._pool = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # MeCab のタガーはスレッドセーフではないので、解析は1スレッドずつ行う
+        self._parse_lock = threading.Lock()
+
+    def _lookup(self, text):
+        with self._lock:
+            tokens = self._cache.get(text)
+            if tokens is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(text)
+            self.hits += 1
+            return tokens
+
+    def _store(self, text, tokens):
+        with self._lock:
+            self._cache[text] = tokens
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _parse_local(self, texts):
+        with self._parse_lock:
+            if self._tagger is None:
+                self._tagger = _new_tagger()
+            return [_parse(self._tagger, text) for text in texts]
+
+    def _parse_pooled(self, texts):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.processes)
+        chunks = [texts[i:i + PROCESS_POOL_CHUNK_SIZE] for i in range(0, len(texts), PROCESS_POOL_CHUNK_SIZE)]
+        return [tokens for parsed in self._pool.map(_parse_in_worker, chunks) for tokens in parsed]
+
+    def tokenize(self, text):
+        tokens = self._lookup(text)
+        if tokens is None:
+            tokens = self._parse_local([text])[0]
+            self._store(text, tokens)
+        return tokens
+
+    def surfaces(self, text):
+        return [surface for surface, _ in self.tokenize(text)]
+
+    def tokenize_many(self, texts):
+        # 列全体をまとめて解析する。重複は1回だけ解析し、入力と同じ順序で返す
+        results = {}
+        missing = []
+        for text in dict.fromkeys(texts):
+            tokens = self._lookup(text)
+            if tokens is None:
+                missing.append(text)
+            else:
+                results[text] = tokens
+        if missing:
+            if self.processes and len(missing) >= PROCESS_POOL_MIN_TEXTS:
+                parsed = self._parse_pooled(missing)
+            else:
+                parsed = self._parse_local(missing)
+            for text, tokens in zip(missing, parsed):
+                results[text] = tokens
+                self._store(text, tokens)
+        return [results[text] for text in texts]
+
+
+_shared_tokenizer = None
+_shared_lock = threading.Lock()
+
+def get_shared_tokenizer():
+    # 辞書の読み込みは重いので、タガーはプロセス内で1つだけ作って全モードで共有する
+    global _shared_tokenizer
+    with _shared_lock:
+        if _shared_tokenizer is None:
+            settings = get_settings("tokenizer")
+            _shared_tokenizer = Tokenizer(
+                cache_size=settings.get("cache_size", DEFAULT_CACHE_SIZE),
+                processes=settings.get("processes", 0)
+            )
+        return _shared_tokenizer